@@ -1,14 +1,20 @@
 from __future__ import annotations
 
 import os
+import sys
+import mmap
+import time
 import shutil
 import docker
+import hashlib
 import logging
 import datetime
-import numpy.random as rnd
+import tempfile
+import threading
+import numpy as np
 
-from collections import OrderedDict
-from typing import Iterable, List, Dict
+from collections import defaultdict
+from typing import Iterable, List, Dict, Tuple, FrozenSet
 
 import util
 
@@ -16,14 +22,137 @@ import util
 MIN_LAYER_SQUASH_SIZE = 1000 
 LAYER_SQUASH_SIM_THRESHOLD = 1 - 1e-6
 LAYER_CHUNK_SIZE = 2 ** 20 # 1MB
+BLOCK_SIZE = 2 ** 12 # 4KB
+LAYER_HEADER_SIZE = BLOCK_SIZE
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+
+class DockerClient:
+
+  # A Docker client per process, whose HTTP session keeps the connections to
+  # the daemon alive across calls. The API calls and their latencies, until 
+  # the responses start, are counted per thread, so that the concurrent jobs
+  # of a process keep their own counts
+  __clients = {}
+  __stats = threading.local()
+
+  @classmethod
+  def get(cls) -> docker.DockerClient:
+    pid = os.getpid()
+    cli = cls.__clients.get(pid)
+    if cli is None:
+      # the sessions inherited from the parent process are not reused
+      cli = docker.from_env()
+      cls.__clients = {pid: cli}
+      send = cli.api.send
+
+      def _send(*args, **kwargs):
+        start = time.time()
+        try:
+          return send(*args, **kwargs)
+        finally:
+          stats = cls.__stats
+          stats.calls = getattr(stats, 'calls', 0) + 1
+          stats.latency = getattr(stats, 'latency', 0.) + time.time() - start
+
+      cli.api.send = _send
+    return cli
+
+  @classmethod
+  def stats(cls) -> Tuple[int, float]:
+    return getattr(cls.__stats, 'calls', 0), getattr(cls.__stats, 'latency', 0.)
+
+  @classmethod
+  def reset_stats(cls):
+    cls.__stats.calls, cls.__stats.latency = 0, 0.
+
+
+class BlockPool:
+
+  # A file of random blocks generated once, from which the layers copy their
+  # content with copy_file_range. The copies are reflinks on file systems
+  # supporting them, e.g., XFS and Btrfs, and in-kernel copies otherwise
+
+  def __init__(self, path: str, size: int):
+    self.__path = path
+    self.__size = max(size // BLOCK_SIZE, 1) * BLOCK_SIZE
+    if not os.path.exists(path) or os.path.getsize(path) != self.__size:
+      self._fill()
+    self.__fd = os.open(path, os.O_RDONLY)
+    self.__mmap = mmap.mmap(self.__fd, 0, access=mmap.ACCESS_READ)
+    self.__buf = memoryview(self.__mmap)
+
+  @property
+  def path(self) -> str:
+    return self.__path
+
+  @property
+  def size(self) -> int:
+    return self.__size
+
+  def copy(self, fd: int, offset: int, count: int, rng: np.random.Generator):
+    # copies count bytes of the pool to fd at offset, starting from a random
+    # block of the pool and wrapping around at its end
+    src = int(rng.integers(self.__size // BLOCK_SIZE)) * BLOCK_SIZE
+    while count > 0:
+      n = min(count, self.__size - src)
+      self._copy_range(src, fd, offset, n)
+      offset, count, src = offset + n, count - n, 0
+
+  def close(self):
+    if self.__fd < 0:
+      return
+    self.__buf.release()
+    self.__mmap.close()
+    os.close(self.__fd)
+    self.__fd = -1
+
+  def _copy_range(self, src: int, fd: int, offset: int, count: int):
+    while count > 0:
+      try:
+        n = os.copy_file_range(self.__fd, fd, count, src, offset)
+      except OSError:
+        n = 0
+      if n == 0:
+        n = os.pwrite(fd, self.__buf[src:src + min(count, LAYER_CHUNK_SIZE)], offset)
+      src, offset, count = src + n, offset + n, count - n
+
+  def _fill(self):
+    logging.info('Filling block pool %s, size: %s ...'%(self.__path, util.size(self.__size)))
+    path = os.path.abspath(self.__path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # the temporary file is unique, as the jobs of a builder may fill the 
+    # same pool at the same time
+    fd, tmp_path = tempfile.mkstemp(prefix='%s.'%os.path.basename(path), suffix='.tmp', dir=os.path.dirname(path))
+    rng = np.random.default_rng()
+    try:
+      with open(fd, 'r+b') as f:
+        f.truncate(self.__size)
+        with mmap.mmap(f.fileno(), self.__size) as buf:
+          for offset in range(0, self.__size, LAYER_CHUNK_SIZE):
+            n = min(LAYER_CHUNK_SIZE, self.__size - offset)
+            buf[offset:offset + n] = rng.bytes(n)
+          buf.flush()
+      os.replace(tmp_path, self.__path)
+    except Exception as e:
+      if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+      raise e
+
+  def __reduce__(self):
+    # reopens the pool instead of pickling the mapping, hence the pool is 
+    # meant to be sent to a worker process once rather than with every task
+    return BlockPool, (self.__path, self.__size)
+
+
 class Layer:
 
+  __slots__ = ('__dgst', '__size')
+
   def __init__(self, dgst: str, size: int):
-    self.__dgst = dgst 
+    self.__dgst = sys.intern(dgst)
     self.__size = size 
 
   @property
@@ -34,27 +163,53 @@ class Layer:
   def size(self) -> int:
     return self.__size
 
-  def build(self, build_dir: str, density: float=.5):
+  def build(self, build_dir: str, density: float=.5, pool: BlockPool=None) -> int:
+    # returns the number of bytes written, excluding the holes
     base = '%s/layer'%build_dir
     os.makedirs(base, exist_ok=True)
     layer_f = '%s/%s'%(base, self.digest)
     if os.path.exists(layer_f):
-      return
+      return 0
+    # the layer is written to a temporary file first, so that a crash never
+    # leaves a partial layer behind
+    tmp_f = '%s.%d.tmp'%(layer_f, os.getpid())
     try:
       logging.debug('Creating layer %s, size: %s ...'%(self.digest, util.size(self.size)))
-      with open(layer_f, 'wb') as f:
+      with open(tmp_f, 'wb') as f:
         if self.size == 0:
-          return 
-        size = self.size - 1
+          os.replace(tmp_f, layer_f)
+          return 0
+        size, load_size = self.size - 1, 0
         if size > 0:
           load_size, empty_size = int(size * density), int(size * (1 - density))
           f.seek(empty_size)
-          f.write(rnd.bytes(load_size))
+          rng = self.rng()
+          if pool is None:
+            for offset in range(0, load_size, LAYER_CHUNK_SIZE):
+              f.write(rng.bytes(min(LAYER_CHUNK_SIZE, load_size - offset)))
+          else:
+            # a unique header keeps the layer digests distinct, and is padded
+            # so that the blocks from the pool are aligned in the layer file
+            header_size = min(load_size, LAYER_HEADER_SIZE + (-(empty_size + LAYER_HEADER_SIZE))%BLOCK_SIZE)
+            f.write(rng.bytes(header_size))
+            f.flush()
+            pool.copy(f.fileno(), empty_size + header_size, load_size - header_size, rng)
+            f.seek(empty_size + load_size)
         f.write(b'\0')
+      os.replace(tmp_f, layer_f)
+      return load_size + 1
     except Exception as e:
       logging.exception('error building layer %s'%self.digest)
+      if os.path.exists(tmp_f):
+        os.remove(tmp_f)
       raise e
 
+  def rng(self) -> np.random.Generator:
+    # an independent random stream keyed on the digest, which makes the layer
+    # content reproducible and distinct across layers built in parallel
+    seed = int.from_bytes(hashlib.sha256(self.digest.encode('utf-8')).digest(), 'big')
+    return np.random.Generator(np.random.PCG64(seed))
+
   def to_json(self) -> Dict[str, object]:
     return {
       'digest': self.digest,
@@ -73,16 +228,25 @@ class Layer:
 
 class Image:
 
+  # layers are indexed by digests, while the tuples of layers and aliases, the
+  # set of layer digests and its fingerprint are cached as read-only views 
+  # until the image is modified
+  __slots__ = ('__repo', '__tag', '__parent', '__layers', '__aliases', '__layer_view', '__alias_view', 
+               '__layer_set', '__fingerprint', '__squashed')
+
   @classmethod
   def ID(cls, repo: str, tag: str) -> str:
     return '%s:%s'%(repo, tag)
 
   def __init__(self, repo: str, tag: str, parent: Image=None, aliases: Iterable[str]=[], layers: Iterable[Layer]=[]):
-    self.__repo = repo 
-    self.__tag = tag
+    self.__repo = sys.intern(repo)
+    self.__tag = sys.intern(tag)
     self.__parent = parent
-    self.__layers = OrderedDict({l.digest: l for l in layers})
+    self.__layers = {l.digest: l for l in layers}
     self.__aliases = set(aliases)
+    self.__layer_view, self.__alias_view = None, None
+    self.__layer_set, self.__fingerprint = None, None
+    self.__squashed = False
 
   @property
   def repo(self) -> str:
@@ -97,12 +261,33 @@ class Image:
     return self.__parent
 
   @property
-  def aliases(self) -> List[str]:
-    return list(self.__aliases)
+  def squashed(self) -> bool:
+    return self.__squashed
+
+  @property
+  def aliases(self) -> Tuple[str, ...]:
+    if self.__alias_view is None:
+      self.__alias_view = tuple(self.__aliases)
+    return self.__alias_view
 
   @property
-  def layers(self) -> List[Layer]:
-    return list(self.__layers.values())
+  def layers(self) -> Tuple[Layer, ...]:
+    if self.__layer_view is None:
+      self.__layer_view = tuple(self.__layers.values())
+    return self.__layer_view
+
+  @property
+  def layer_set(self) -> FrozenSet[str]:
+    if self.__layer_set is None:
+      self.__layer_set = frozenset(self.__layers)
+    return self.__layer_set
+
+  @property
+  def fingerprint(self) -> str:
+    # canonical fingerprint of the layer set, shared by the aliases
+    if self.__fingerprint is None:
+      self.__fingerprint = hashlib.sha256('\n'.join(sorted(self.__layers)).encode('utf-8')).hexdigest()
+    return self.__fingerprint
 
   @parent.setter
   def parent(self, p: Image):
@@ -112,48 +297,105 @@ class Image:
     layers = self.__layers
     if (dgst in layers and layers[dgst].size < size) or dgst not in layers:
       layers[dgst] = Layer(dgst, size)
+      self.__layer_view, self.__layer_set, self.__fingerprint = None, None, None
+      self.__squashed = False
     return layers[dgst]
   
   def add_alias(self, i: Image):
     if i:
-      self.__aliases.add(str(i))
+      self.__aliases.add(sys.intern(str(i)))
+      self.__alias_view = None
 
   def is_child(self, p: Image) -> bool:
     if not isinstance(p, Image): 
       return False 
     if p.parent == str(self):
       return False
-    p_layers = set(l.digest for l in p.layers)
-    if not p_layers.issubset(self.__layers.keys()) or len(self.layers) == len(p_layers):
+    p_layers = p.layer_set
+    if len(self.__layers) == len(p_layers) or not p_layers.issubset(self.layer_set):
       return False
-    return self.__parent is None or len(p.layers) > len(self.__parent.layers)
+    return self.__parent is None or len(p_layers) > len(self.__parent.__layers)
   
   def has_alias(self, i: Image) -> bool:
     if not isinstance(i, Image):
       return False 
-    a_layers = set(l.digest for l in i.layers)
-    return a_layers == set(self.__layers.keys())
+    return i.fingerprint == self.fingerprint and i.layer_set == self.layer_set
 
   def squash_layers(self):
-    parent = self.__parent
-    if parent:
-      for l in parent.layers:
-        self.__layers.pop(l.digest, None)
-        
-    layers, layer_sizes = self.__layers, {}
-    for l in layers.values():
-      layer_sizes.setdefault(l.size, []).append(l)
-
-    to_squash = []
-    sorted_sizes = sorted(layer_sizes.items())
-    for i, (size, ls) in enumerate(sorted_sizes[:-1]):
-      adj_size, _ = sorted_sizes[i + 1]
-      if size/adj_size > LAYER_SQUASH_SIM_THRESHOLD:
-        to_squash += ls
-      elif len(ls) > 1 and size > MIN_LAYER_SQUASH_SIZE:
-        to_squash += ls[:-1]
-    for l in to_squash:
-      layers.pop(l.digest)
+    Image.squash_images([self])
+
+  @staticmethod
+  def squash_images(images: Iterable[Image]) -> Dict[str, Tuple[Layer, ...]]:
+    # Squashes the layers of all the images at once: the layers of the parents
+    # are popped, then the layers whose sizes are similar to the next larger
+    # size, and the duplicate sizes above MIN_LAYER_SQUASH_SIZE except for the
+    # last layer of the size. The layers of the parents are taken before any
+    # image is squashed in this call, and squashed images are skipped
+    images = list(images)
+    targets = [i for i in images if not i.__squashed]
+    if targets:
+      Image.__squash(targets)
+    return {str(i): i.layers for i in images}
+
+  @staticmethod
+  def __squash(targets: List[Image]):
+    # rows of layers of the targets followed by those of the parents not
+    # being squashed
+    index = {id(i): k for k, i in enumerate(targets)}
+    imgs = list(targets)
+    for i in targets:
+      p = i.__parent
+      if p is not None and id(p) not in index:
+        index[id(p)] = len(imgs)
+        imgs += p,
+    img_layers = [i.layers for i in imgs]
+    counts = np.array([len(ls) for ls in img_layers], dtype=np.int64)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    lids = {}
+    lid = np.array([lids.setdefault(l.digest, len(lids)) for ls in img_layers for l in ls], dtype=np.int64)
+    size = np.array([l.size for ls in img_layers for l in ls], dtype=np.int64)
+    owner = np.repeat(np.arange(len(imgs), dtype=np.int64), counts)
+    n_rows = int(counts[:len(targets)].sum())
+
+    # drop the layers of the parents
+    children = np.array([k for k, i in enumerate(targets) if i.__parent is not None], dtype=np.int64)
+    parents = np.array([index[id(targets[k].__parent)] for k in children], dtype=np.int64)
+    p_counts = counts[parents]
+    p_rows = (np.arange(int(p_counts.sum()), dtype=np.int64)
+              - np.repeat(np.cumsum(p_counts) - p_counts, p_counts)
+              + np.repeat(starts[parents], p_counts))
+    n_lids = max(len(lids), 1)
+    p_keys = np.repeat(children, p_counts) * n_lids + lid[p_rows]
+    rows = np.arange(n_rows, dtype=np.int64)
+    rows = rows[~np.isin(owner[:n_rows] * n_lids + lid[:n_rows], p_keys)]
+
+    # group the remaining layers of every image by sizes, in layer order
+    rows = rows[np.lexsort((rows, size[rows], owner[rows]))]
+    r_owner, r_size = owner[rows], size[rows]
+    first = np.ones(len(rows), dtype=bool)
+    first[1:] = (r_owner[1:] != r_owner[:-1]) | (r_size[1:] != r_size[:-1])
+    gid = np.cumsum(first) - 1
+    g_start = np.flatnonzero(first)
+    g_owner, g_size = r_owner[g_start], r_size[g_start]
+    g_count = np.diff(np.append(g_start, len(rows)))
+    has_next = np.zeros(len(g_start), dtype=bool)
+    has_next[:-1] = g_owner[1:] == g_owner[:-1]
+    next_size = np.ones(len(g_start), dtype=np.int64)
+    next_size[:-1] = g_size[1:]
+    similar = has_next & (g_size / np.where(has_next, next_size, 1) > LAYER_SQUASH_SIM_THRESHOLD)
+    dup = has_next & ~similar & (g_count > 1) & (g_size > MIN_LAYER_SQUASH_SIZE)
+    last = np.ones(len(rows), dtype=bool)
+    last[:-1] = gid[1:] != gid[:-1]
+    survived = np.sort(rows[~(similar[gid] | (dup[gid] & ~last))])
+
+    # rebuild the layers of the targets from the surviving rows
+    bounds = np.searchsorted(survived, np.append(starts[:len(targets)], n_rows))
+    survived = survived.tolist()
+    for k, i in enumerate(targets):
+      layers, s = img_layers[k], int(starts[k])
+      i.__layers = {layers[r - s].digest: layers[r - s] for r in survived[bounds[k]:bounds[k + 1]]}
+      i.__layer_view, i.__layer_set, i.__fingerprint = None, None, None
+      i.__squashed = True
 
   def to_json(self) -> Dict[str, object]:
     return {
@@ -164,9 +406,11 @@ class Image:
       'layers': [l.digest for l in self.layers],
     }
 
-  def build(self, build_dir: str, registry: str=None) -> docker.models.images.Image:
+  def build(self, build_dir: str, registry: str=None, pool: BlockPool=None, layer_dir: str=None) -> docker.models.images.Image:
+    # the layers are built in the layer directory, by default the build directory
+    layer_dir = layer_dir or build_dir
     base = '%s/image'%build_dir
-    layer_base = '%s/layer'%build_dir
+    layer_base = '%s/layer'%layer_dir
     if self.parent and registry:
       base_img = '%s/%s'%(registry, self.parent)
     elif not registry:
@@ -174,7 +418,7 @@ class Image:
     else:
       base_img = 'scratch'
     logging.debug("Building %s ..."%self)
-    docker_cli = docker.from_env()
+    docker_cli = DockerClient.get()
     dockerfile = ['FROM %s'%base_img]
     img_dir = '%s/%s'%(base, self)
     if os.path.exists(img_dir):
@@ -182,16 +426,21 @@ class Image:
     os.makedirs(img_dir, exist_ok=True)
     for l in self.layers:
       logging.debug("Generating layer %s, size %s"%(l.digest, util.size(l.size)))
-      l.build(build_dir)
+      l.build(layer_dir, pool=pool)
       os.link('%s/%s'%(layer_base, l.digest), '%s/%s'%(img_dir, l.digest))
       dockerfile += 'COPY %s /%s'%(l.digest, l.digest),
     df_path = '%s/Dockerfile'%img_dir
     with open(df_path, 'w') as f:
       f.write('\n'.join(dockerfile))
     tag = '%s/%s'%(registry, str(self)) if registry else str(self)
-    img, _ = docker_cli.images.build(path=img_dir, tag=tag, rm=True,
-                                     dockerfile=os.path.abspath(df_path))
-    api = docker.APIClient()
+    try:
+      img, _ = docker_cli.images.build(path=img_dir, tag=tag, rm=True,
+                                       dockerfile=os.path.abspath(df_path))
+    finally:
+      # the build context holds links to the layers, which would keep the 
+      # layers on disk after they are freed
+      shutil.rmtree(img_dir, ignore_errors=True)
+    api = docker_cli.api
     for a in self.aliases:
       repo, tag = a.split(':')
       if registry:
@@ -200,14 +449,14 @@ class Image:
     return img
 
   def push(self, registry: str=None):
-    docker_cli = docker.from_env()
+    docker_cli = DockerClient.get()
     repo = '%s/%s'%(registry, self.repo) if registry else self.repo
     docker_cli.images.push(repo, self.tag)
   
   def push_aliases(self, registry: str=None):
     if len(self.aliases) == 0:
       return 
-    docker_cli = docker.from_env()
+    docker_cli = DockerClient.get()
     for a in self.aliases:
       repo, tag = a.split(':')
       if registry:
@@ -215,7 +464,7 @@ class Image:
       docker_cli.images.push(repo, tag)
   
   def prune(self, registry: str=None):
-    docker_cli = docker.from_env()
+    docker_cli = DockerClient.get()
     docker_cli.images.remove('%s/%s'%(registry, str(self)) if registry else str(self))
 
   def __str__(self) -> str:
@@ -227,4 +476,51 @@ class Image:
   def __hash__(self) -> int:
     return hash((self.repo, self.tag))
 
-  
\ No newline at end of file
+  
+
+
+class ImageIndex:
+
+  # An index of the distinct layer sets of the images, grouped by their
+  # fingerprints in the order of the images, for batch queries of the layer 
+  # sets related to a set of layers. The index is a snapshot of the images
+  # when it is built
+
+  def __init__(self, images: Iterable[Image]):
+    self.__groups = {}
+    for i in images:
+      self.__groups.setdefault(i.fingerprint, []).append(i)
+    self.__sets = {fp: g[0].layer_set for fp, g in self.__groups.items()}
+    # every layer set is listed under its layers for superset queries, and
+    # under its rarest layer, which any of its supersets contain, for subset
+    # queries
+    self.__by_layer = defaultdict(list)
+    for fp, s in self.__sets.items():
+      for d in s:
+        self.__by_layer[d] += fp,
+    self.__by_rarest = defaultdict(list)
+    for fp, s in self.__sets.items():
+      if s:
+        self.__by_rarest[min(s, key=lambda d: (len(self.__by_layer[d]), d))] += fp,
+
+  @property
+  def groups(self) -> Dict[str, List[Image]]:
+    return self.__groups
+
+  def layer_set(self, fp: str) -> FrozenSet[str]:
+    return self.__sets[fp]
+
+  def supersets(self, layers: Iterable[str], strict: bool=True) -> List[str]:
+    # fingerprints of the layer sets containing all the layers
+    layers = frozenset(layers)
+    if not layers:
+      return [fp for fp, s in self.__sets.items() if s or not strict]
+    postings = sorted((self.__by_layer.get(d, ()) for d in layers), key=len)
+    return [fp for fp in postings[0] 
+            if layers.issubset(self.__sets[fp]) and (not strict or len(self.__sets[fp]) > len(layers))]
+
+  def subsets(self, layers: Iterable[str], strict: bool=True) -> List[str]:
+    # fingerprints of the non-empty layer sets contained in the layers
+    layers = frozenset(layers)
+    return [fp for d in layers for fp in self.__by_rarest.get(d, ()) 
+            if self.__sets[fp].issubset(layers) and (not strict or len(self.__sets[fp]) < len(layers))]
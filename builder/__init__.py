@@ -1,48 +1,129 @@
+from __future__ import annotations
+
 import os
-import queue
+import time
+import heapq
 import docker
+import queue
 import logging
-import requests
 import tempfile
+import threading
+import contextlib
 import multiprocessing as mp
 
-from typing import Iterable, Dict, List, Tuple
+from collections import Counter
+from concurrent import futures
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Iterable, Dict, List, Set, Tuple
 
 import util
 import builder.builder_pb2 as pb2
 
-from base import Image, Layer
+from base import Image, Layer, BlockPool, DockerClient
+from builder.oci import ImageAssembler
+from builder.store import LayerStore
+from builder.stats import BuildStats, PhaseTimer, log_summary
+from builder.registry import RegistryClient
+
+
+# interval in seconds to check for newly arrived images while building others
+FEED_POLL_INTERVAL = .1
+
+# the workers are started by a fork server instead of being forked from the 
+# builder, whose threads, e.g., those of gRPC, may hold locks while forking
+_mp = mp.get_context('forkserver')
 
 
 class Builder:
 
-  def __init__(self, registry: str, scaling_factor: int, build_dir: str):
+  def __init__(self, registry: str, scaling_factor: int, build_dir: str, pool_size: int=0, backend: str='docker', 
+               list_registry: bool=False, store: LayerStore=None, disk_budget: int=0, 
+               listener: Callable[[pb2.BuildEvent], None]=None, cancelled: threading.Event=None):
     self.__registry = registry
+    self.__client = RegistryClient(registry)
+    self.__list_registry = list_registry
     self.__scaling_factor = scaling_factor
     self.__build_dir = tempfile.mkdtemp(dir=build_dir)
+    # the layers are kept in the store across builds if any, or in the 
+    # build directory otherwise
+    self.__store = store
+    self.__layer_dir = store.path if store else self.__build_dir
+    self.__pool_size = pool_size
+    self.__pool = None
+    # the layers are generated along with the images within the disk budget 
+    # if any, or all up front otherwise
+    self.__disk_budget = disk_budget
+    # the OCI backend assembles and pushes the images without the Docker daemon
+    self.__assembler = ImageAssembler(self.__layer_dir, registry) if backend == 'oci' else None
+    # the listener is notified of the progress events of the build
+    self.__listener = listener
+    # no more layers or images are built once the build is cancelled, which
+    # fails after the images being built are done
+    self.__cancelled = cancelled or threading.Event()
+    self.__stats = None
+    # the local tags of the images built via the Docker daemon, which are
+    # removed once the build is done
+    self.__tags = set()
 
   @property
   def registry(self) -> str:
     return self.__registry
 
-  def build(self, bs: pb2.ImageBuildSet) -> int:
+  def build(self, bs: pb2.ImageBuildSet) -> pb2.ImageBuildSummary:
+    # the layers are generated up front unless a disk budget is set
+    return self._build([bs], self.__disk_budget == 0)
+
+  def build_stream(self, build_sets: Iterable[pb2.ImageBuildSet]) -> pb2.ImageBuildSummary:
+    # the build sets arrive in the dependency order of the images, which are
+    # built as soon as they arrive along with their layers
+    return self._build(build_sets, False)
+
+  def _build(self, build_sets: Iterable[pb2.ImageBuildSet], prebuild: bool) -> pb2.ImageBuildSummary:
+    DockerClient.reset_stats()
+    self.__stats = BuildStats()
+    store, digests, sizes = self.__store, [], {}
+
+    def _batches():
+      for bs in build_sets:
+        self._check_cancelled()
+        for l in self._get_unique_layers(bs.images):
+          sizes[l.digest] = l.size
+        new_images, existed = self._filter_existing_images(bs.images)
+        layers = self._get_unique_layers(new_images)
+        digests.extend(l.digest for l in layers)
+        if store:
+          store.acquire(l.digest for l in layers)
+        yield new_images, existed, self._build_layers(layers) if prebuild else {}
+
+    pipeline = None if prebuild else LayerPipeline(self.__layer_dir, self.__disk_budget, store, 
+                                                   self.__assembler is not None)
     try:
-      new_images, existed = self._filter_existing_images(bs.images)
-      layers = self._build_layers(self._get_unique_layers(new_images))
-      self._build_images(new_images, existed, layers)
+      if self.__pool_size > 0:
+        self.__pool = BlockPool('%s/pool'%self.__layer_dir, self.__pool_size)
+      self._build_images(_batches(), pipeline)
     finally:
+      if self.__pool:
+        self.__pool.close()
+      if store:
+        # the layers freed by the pipeline are released to the store already
+        store.add(digests)
+        store.release((Counter(digests) - Counter(pipeline.released if pipeline else [])).elements())
       self._clean_up()
-    return int(sum(l.size for l in self._get_unique_layers(bs.images)))
+      self.__stats.add_api_calls(*DockerClient.stats())
+    summary = self.__stats.summary(int(sum(sizes.values())))
+    log_summary(summary)
+    return summary
 
   def _filter_existing_images(self, images: Iterable[pb2.Image]) -> List[pb2.Image]:
-    man_url_template = 'http://%s/v2/%s/manifests/%s'
     filtered, existed = {}, {}
+    start = time.time()
+    refs = self.__client.has_manifests((a for i in images for a in ['%s:%s'%(i.repo, i.tag)] + list(i.aliases)), 
+                                       list_tags=self.__list_registry)
+    self.__stats.record('check', time.time() - start)
     for i in images:
       aliases = ['%s:%s'%(i.repo, i.tag)] + list(i.aliases)
       for a in aliases:
-        repo, tag = a.split(':')
-        r = requests.head(man_url_template%(self.registry, repo, tag))
-        if r.ok:
+        if refs[a]:
           existed[(i.repo, i.tag)] = i
         else:
           filtered[(i.repo, i.tag)] = i
@@ -58,97 +139,475 @@ class Builder:
 
   def _build_layers(self, layers: Iterable[pb2.Layer]) -> Dict[str, Layer]:
     layers = {l.digest: Layer(l.digest, l.size) for l in layers}
-    n_parallel = int(mp.cpu_count() * self.__scaling_factor)
-    sema = mp.Semaphore(n_parallel) 
-    build_dir = self.__build_dir
-    
-    def _build(l):
-      with sema:
-        l.build(build_dir)
-
+    build_dir = self.__layer_dir
     total_size = int(sum(l.size for l in layers.values()))
     logging.info('Building %d layers in %s, total size: %s'%(len(layers), build_dir, util.size(total_size)))
+    if not layers:
+      return layers
 
-    wait_q = list(layers.values())
-    while len(wait_q) > 0:
-      n_procs = min(1000, len(wait_q))
-      procs = [mp.Process(target=_build, args=(l, )) for l in wait_q[:n_procs]]
-      try:
-        for p in procs:
-          p.start()
-        for p in procs:
-          p.join()
-      finally:
-        for p in procs:
-          if p.is_alive(): 
-            p.terminate()
-      wait_q = wait_q[n_procs:]
+    # the largest layers are built first so that the stragglers are small
+    wait_q = sorted(layers.values(), key=lambda l: l.size, reverse=True)
+    n_parallel = max(1, min(int(mp.cpu_count() * self.__scaling_factor), len(wait_q)))
+    args = [(l, build_dir, self.__assembler) for l in wait_q]
+    start, done, written = time.time(), 0, 0
+    with _mp.Pool(n_parallel, initializer=_init_worker, initargs=(self.__pool, )) as workers:
+      for l, n_bytes, samples in workers.imap_unordered(_build_layer, args):
+        self.__stats.add(samples)
+        done, written = done + 1, written + n_bytes
+        elapsed = max(time.time() - start, 1e-6)
+        logging.info('[%d/%d] Built layer %s, size: %s, written: %s, %s/s'%(done, len(wait_q), l.digest, 
+                     util.size(l.size), util.size(written), util.size(written/elapsed)))
+        self._notify(kind=pb2.BuildEvent.LAYER_BUILT, layer=l.digest, bytes=n_bytes)
+        self._check_cancelled()
     return layers
 
-  def _build_images(self, images: Iterable[pb2.Image], existed: Iterable[pb2.Image], layers: Dict[str, Layer],) -> List[Image]:
-    to_build, refs, exist = {}, {}, set()
+  def _build_images(self, batches: Iterable[Tuple[List[pb2.Image], List[pb2.Image], Dict[str, Layer]]], 
+                    pipeline: LayerPipeline=None) -> List[Image]:
+    # the batches of images are taken by the scheduler as they arrive, while
+    # the images already taken are being built
+    scheduler = ImageScheduler(pipeline)
+    arrivals = queue.Queue()
+
+    def _feed():
+      try:
+        for b in batches:
+          arrivals.put(b)
+        arrivals.put(None)
+      except Exception as e:
+        arrivals.put(e)
+
+    threading.Thread(target=_feed, daemon=True).start()
+
+    n_parallel = max(1, int(mp.cpu_count() * self.__scaling_factor))
+    feeding, error, running, started = True, None, {}, 0
+
+    def _workers() -> futures.ProcessPoolExecutor:
+      return stack.enter_context(futures.ProcessPoolExecutor(n_parallel, mp_context=_mp, initializer=_init_worker, 
+                                                             initargs=(self.__pool, )))
+
+    with contextlib.ExitStack() as stack:
+      workers = _workers()
+      while feeding or scheduler.ready or running:
+        if feeding and self.__cancelled.is_set():
+          # the images being built are waited for, while the others are not
+          feeding, error = False, RuntimeError('Build cancelled')
+        while feeding:
+          try:
+            # the arrivals are polled while idle to notice the cancellation
+            b = arrivals.get(block=not running and not scheduler.ready, timeout=FEED_POLL_INTERVAL)
+          except queue.Empty:
+            break
+          if b is None or isinstance(b, Exception):
+            feeding, error = False, b
+            break
+          scheduler.add(*b)
+        while len(running) < n_parallel and not self.__cancelled.is_set():
+          item = scheduler.next(force=not running)
+          if item is None:
+            break
+          image, new_layers = item
+          started += 1
+          if not self.__assembler:
+            self.__tags.update(self._local_tags(image))
+          args = (started, scheduler.total, image, new_layers, self.__build_dir, self.__layer_dir, self.registry, 
+                  self.__assembler)
+          try:
+            f = workers.submit(_build_image, args)
+          except BrokenProcessPool as e:
+            # the images running when a worker died fail, while the others 
+            # are built by a new pool
+            logging.error('Worker pool is broken, restarting: %s'%e)
+            workers = _workers()
+            f = workers.submit(_build_image, args)
+          running[f] = str(image)
+        if not running:
+          if self.__cancelled.is_set():
+            break
+          continue
+        done, _ = futures.wait(running, timeout=FEED_POLL_INTERVAL if feeding else None, 
+                               return_when=futures.FIRST_COMPLETED)
+        for f in done:
+          img_id = running.pop(f)
+          if f.exception():
+            logging.error('Failed to build image %s: %s'%(img_id, f.exception()))
+            self._notify(kind=pb2.BuildEvent.IMAGE_FAILED, image=img_id, error=str(f.exception()))
+            scheduler.done(img_id, False)
+            self.__stats.image_done(False)
+            continue
+          elapsed, n_bytes, samples, api_calls = f.result()
+          self.__stats.add(samples)
+          self.__stats.add_api_calls(*api_calls)
+          self._notify(kind=pb2.BuildEvent.IMAGE_PUSHED, image=img_id, bytes=n_bytes, duration=elapsed)
+          scheduler.done(img_id, True)
+          self.__stats.image_done(True)
+    if pipeline:
+      logging.info('Peak disk usage of the layers: %s, budget: %s'%(util.size(pipeline.peak_usage), 
+                   util.size(self.__disk_budget) if self.__disk_budget > 0 else 'unlimited'))
+    if scheduler.failed:
+      logging.error('Failed to build %d images'%len(scheduler.failed))
+    if scheduler.pending and self.__cancelled.is_set():
+      error = error or RuntimeError('Build cancelled')
+      logging.warning('Cancelled %d images'%len(scheduler.pending))
+    elif scheduler.pending:
+      logging.warning('Skipped %d images whose parents are not built'%len(scheduler.pending))
+    if error:
+      raise error
+    return scheduler.pending
+
+  def _notify(self, **kwargs):
+    if self.__listener:
+      self.__listener(pb2.BuildEvent(**kwargs))
+
+  def _check_cancelled(self):
+    if self.__cancelled.is_set():
+      raise RuntimeError('Build cancelled')
+  
+  def _local_tags(self, image: Image) -> List[str]:
+    # the tags of the image and its aliases, and of its parent pulled as the
+    # base image
+    refs = [str(image)] + list(image.aliases) + ([str(image.parent)] if image.parent else [])
+    return ['%s/%s'%(self.registry, r) for r in refs]
+
+  def _clean_up(self):
+    # only the images tagged by this build are removed, as other builds may be
+    # running on the same Docker daemon
+    if self.__tags:
+      cli = DockerClient.get()
+      for t in sorted(self.__tags):
+        try:
+          cli.images.remove(t)
+        except docker.errors.ImageNotFound:
+          pass
+        except docker.errors.APIError as e:
+          logging.warning('Failed to remove image %s: %s'%(t, e))
+      self.__tags.clear()
+    os.system('rm -rf %s'%self.__build_dir)
+
+
+# the block pool of the worker process, which is set up once per process
+# instead of being sent with every task
+_pool = None
+
+
+def _init_worker(pool: BlockPool):
+  global _pool
+  _pool = pool
+
+
+def _build_layer(args: Tuple[Layer, str, ImageAssembler]) -> Tuple[Layer, int, List[Tuple[str, float, int]]]:
+  # returns the layer, the bytes written and the timings of the phases
+  l, build_dir, assembler = args
+  timer = PhaseTimer()
+  start = timer.start()
+  n_bytes = l.build(build_dir, pool=_pool)
+  timer.stop('layer', start, n_bytes)
+  if assembler:
+    start = timer.start()
+    blob = assembler.pack(l)
+    timer.stop('pack', start, blob.size)
+  return l, n_bytes, timer.samples
+
+
+class LayerPipeline:
+
+  # Tracks the layers of the images on disk when they are generated along 
+  # with the images: an image is admitted once the layers it has to generate
+  # fit in the disk budget and none of its layers is being generated for 
+  # another image, and a layer is freed once all the images referencing it 
+  # are done. An image is admitted regardless of the budget if no other image
+  # is running, so that the build always progresses. Without a budget, the 
+  # layers are kept until the end of the build. The layers freed in a layer 
+  # store are released to the store, which decides whether to evict them. 
+  # With blobs, i.e., the OCI backend, the gzipped blob of a layer is on disk
+  # as well, which is counted at the layer size until it is packed
+  def __init__(self, layer_dir: str, budget: int=0, store: LayerStore=None, blobs: bool=False):
+    self.__layer_dir = layer_dir
+    self.__budget = budget
+    self.__store = store
+    self.__blobs = blobs
+    self.__released = []
+    self.__refs = Counter()
+    self.__on_disk = {}
+    self.__claims = {}
+    self.__usage = self.__peak_usage = 0
+
+  @property
+  def usage(self) -> int:
+    return self.__usage
+
+  @property
+  def peak_usage(self) -> int:
+    return self.__peak_usage
+
+  @property
+  def released(self) -> List[str]:
+    # the layers released to the store
+    return self.__released
+
+  def add(self, images: Iterable[Image]):
+    for i in images:
+      for l in i.layers:
+        d = l.digest
+        self.__refs[d] += 1
+        # the layers reused from an earlier build are on disk already
+        if d not in self.__on_disk and os.path.exists('%s/layer/%s'%(self.__layer_dir, d)):
+          self.__on_disk[d] = self._disk_size(l)
+          self.__usage += self.__on_disk[d]
+    self.__peak_usage = max(self.__peak_usage, self.__usage)
+
+  def admit(self, image: Image, force: bool=False) -> List[Layer]:
+    # returns the layers to generate for the image, or None if the image 
+    # has to wait
+    claimed = set(d for ds in self.__claims.values() for d in ds)
+    if any(l.digest in claimed for l in image.layers):
+      return None
+    new_layers = [l for l in image.layers if l.digest not in self.__on_disk]
+    sizes = [self._disk_size(l) for l in new_layers]
+    size = int(sum(sizes))
+    over_budget = self.__budget > 0 and self.__usage + size > self.__budget
+    if over_budget and not force:
+      return None
+    if over_budget:
+      logging.warning('Building image %s over the disk budget, usage: %s, budget: %s'%(image, 
+                      util.size(self.__usage + size), util.size(self.__budget)))
+    self.__claims[str(image)] = [l.digest for l in new_layers]
+    for l, n in zip(new_layers, sizes):
+      self.__on_disk[l.digest] = n
+    self.__usage += size
+    self.__peak_usage = max(self.__peak_usage, self.__usage)
+    return new_layers
+
+  def release(self, image: Image):
+    # the layers a failed image did not generate are not on disk, while the
+    # others are counted at their sizes on disk
+    layers = {l.digest: l for l in image.layers}
+    for d in self.__claims.pop(str(image), []):
+      if not os.path.exists('%s/layer/%s'%(self.__layer_dir, d)):
+        self.__usage -= self.__on_disk.pop(d)
+        continue
+      n = self._disk_size(layers[d])
+      self.__usage += n - self.__on_disk[d]
+      self.__on_disk[d] = n
+    freed = []
+    for l in image.layers:
+      d = l.digest
+      self.__refs[d] -= 1
+      if self.__budget <= 0 or self.__refs[d] > 0 or d not in self.__on_disk:
+        continue
+      del self.__refs[d]
+      self.__usage -= self.__on_disk.pop(d)
+      freed += d,
+    if self.__store:
+      self.__store.add(freed)
+      self.__store.release(freed)
+      self.__released += freed
+      return
+    for d in freed:
+      for f in ('%s/layer/%s'%(self.__layer_dir, d), '%s/blob/%s'%(self.__layer_dir, d), 
+                '%s/blob/%s.json'%(self.__layer_dir, d)):
+        if os.path.exists(f):
+          os.remove(f)
+
+  def _disk_size(self, layer: Layer) -> int:
+    # the layer size plus the size of its blob if any, or the layer size if
+    # the blob is not packed yet, as the blobs are never larger by much
+    if not self.__blobs:
+      return layer.size
+    blob_f = '%s/blob/%s'%(self.__layer_dir, layer.digest)
+    return layer.size + (os.path.getsize(blob_f) if os.path.exists(blob_f) else layer.size)
+
+
+class ImageScheduler:
+
+  # Schedules the images to build as soon as their parents are pushed, with
+  # the ones on the longest remaining chain of bytes to build first. Images 
+  # are added in batches in the dependency order, while the images added 
+  # earlier are being built, and only the pending images are kept. The first
+  # image of a group of aliases is elected to be built, and the others are 
+  # tagged as its aliases. The ranks are only updated for the images added 
+  # and their ancestors, whose stale entries in the ready queue are skipped
+  def __init__(self, pipeline: LayerPipeline=None):
+    self.__pipeline = pipeline
+    self.__to_build = {}
+    # references to the IDs of the elected or existing images
+    self.__refs = {}
+    self.__exist = set()
+    self.__children = {}
+    self.__ranks = {}
+    self.__ready, self.__ready_ids = [], set()
+    self.__built, self.__failed = set(), set()
+    self.__total = 0
+
+  @property
+  def total(self) -> int:
+    return self.__total
+
+  @property
+  def ready(self) -> bool:
+    return len(self.__ready_ids) > 0
+
+  @property
+  def pending(self) -> List[Image]:
+    return list(self.__to_build.values())
+
+  @property
+  def built(self) -> Set[str]:
+    return self.__built
+
+  @property
+  def failed(self) -> Set[str]:
+    return self.__failed
+
+  def add(self, images: Iterable[pb2.Image], existed: Iterable[pb2.Image], layers: Dict[str, Layer]):
     for i in existed:
-      img = Image(i.repo, i.tag)
-      aliases = [str(img)] + list(i.aliases)
-      for a in aliases:
-        refs[a] = img
-        exist.add(a)
+      img_id = Image.ID(i.repo, i.tag)
+      for a in [img_id] + list(i.aliases):
+        self.__refs.setdefault(a, img_id)
+        self.__exist.add(a)
+    added = []
     for i in images:
-      ls = [layers[l.digest] for l in i.layers if l.digest in layers]
+      img_id = Image.ID(i.repo, i.tag)
+      if self.__refs.get(img_id, img_id) != img_id or img_id in self.__to_build or img_id in self.__built:
+        continue
+      ls = [layers.get(l.digest) or Layer(l.digest, l.size) for l in i.layers]
       img = Image(i.repo, i.tag, aliases=i.aliases, layers=ls)
-      img_id = str(img)
-      to_build[img_id] = img
-      aliases = [img_id] + list(i.aliases)
-      for a in aliases:
-        refs[a] = img
+      for a in [img_id] + list(i.aliases):
+        if self.__refs.get(a) not in self.__to_build and self.__refs.get(a) not in self.__built:
+          self.__refs[a] = img_id
+      self.__to_build[img_id] = img
+      added += (img, i.parent),
+    if not added:
+      return
+    # the parents are referred to by the IDs of the images elected for them
+    for img, parent in added:
+      if parent:
+        img.parent = Image(*self.__refs.get(parent, parent).split(':'))
+    added = [img for img, _ in added]
+    self.__total += len(added)
+    logging.info('Building %d more images, total: %d'%(len(added), self.__total))
+    if self.__pipeline:
+      self.__pipeline.add(added)
+    for i in added:
+      if i.parent and str(i.parent) not in self.__exist and str(i.parent) not in self.__built:
+        self.__children.setdefault(str(i.parent), []).append(i)
+    for img_id in self._rank_critical_path(added):
+      if img_id in self.__ready_ids:
+        self._push_ready(img_id)
+    for i in added:
+      if not i.parent or str(i.parent) in self.__exist or str(i.parent) in self.__built:
+        self._push_ready(str(i))
+
+  def next(self, force: bool=False) -> Tuple[Image, List[Layer]]:
+    # pops the ready image with the highest rank admitted by the pipeline, 
+    # along with the layers to generate for it
+    deferred, item = [], None
+    while self.__ready:
+      entry = heapq.heappop(self.__ready)
+      img_id = entry[1]
+      if img_id not in self.__ready_ids or -entry[0] != self.__ranks[img_id]:
+        continue
+      image = self.__to_build[img_id]
+      new_layers = self.__pipeline.admit(image, force=force) if self.__pipeline else []
+      if new_layers is not None:
+        self.__ready_ids.remove(img_id)
+        item = (image, new_layers)
+        break
+      deferred += entry,
+    for entry in deferred:
+      heapq.heappush(self.__ready, entry)
+    return item
+
+  def done(self, img_id: str, ok: bool):
+    image = self.__to_build.pop(img_id)
+    self.__ranks.pop(img_id, None)
+    if self.__pipeline:
+      self.__pipeline.release(image)
+    if not ok:
+      self.__failed.add(img_id)
+      return
+    self.__built.add(img_id)
+    for c in self.__children.pop(img_id, []):
+      self._push_ready(str(c))
+
+  def _push_ready(self, img_id: str):
+    self.__ready_ids.add(img_id)
+    heapq.heappush(self.__ready, (-self.__ranks[img_id], img_id))
+
+  def _rank_critical_path(self, images: Iterable[Image]) -> Set[str]:
+    # ranks the added images by their bytes and the heaviest chain of their 
+    # pending descendants, and raises the ranks of their pending ancestors. 
+    # Returns the IDs of the images whose ranks have changed
+    ranks, visiting, children, changed = self.__ranks, set(), self.__children, set()
+    for root in images:
+      stack = [(root, False)]
+      while stack:
+        i, expanded = stack.pop()
+        img_id = str(i)
+        if img_id in ranks:
+          continue
+        if not expanded:
+          visiting.add(img_id)
+          stack += (i, True),
+          stack += [(c, False) for c in children.get(img_id, []) if str(c) not in ranks and str(c) not in visiting]
+          continue
+        ranks[img_id] = (int(sum(l.size for l in i.layers)) 
+                         + max((ranks.get(str(c), 0) for c in children.get(img_id, [])), default=0))
+        changed.add(img_id)
     for i in images:
-      if i.parent:
-        to_build[Image.ID(i.repo, i.tag)].parent = refs.get(i.parent, Image(*i.parent.split(':')))
-    # elect a major image to build and tag other aliases
-    elected = set()
-    for i in dict(to_build).values():
-      elected.add(str(i))
-      for a in i.aliases:
-        if a not in elected:
-          to_build.pop(a, None)
-
-    def _build(idx, total, image):
-      with sema:
-        logging.info('[%d/%d] Building image %s ...'%(idx, total, image))
-        image.build(self.__build_dir, self.registry)
-        logging.info('[%d/%d] Pushing image %s to %s ...'%(idx, total, image, self.registry))
-        image.push(self.registry)
-        logging.info('[%d/%d] Deleting image %s ...'%(idx, total, image))
-        image.prune(self.registry)
-        if len(image.aliases) > 0:
-          logging.info('[%d/%d] Pushing %d aliases of %s to %s ...'%(idx, total, len(image.aliases), image, self.registry))
-          image.push_aliases(self.registry)
-    
-    logging.info('Building a total of %d images'%len(to_build))
-
-    built = set()
-    ready = [i for i in to_build.values() if not i.parent or str(i.parent) in built or str(i.parent) in exist]
-    while ready:
-      procs = [mp.Process(target=_build, args=(len(built) + idx + 1, len(to_build), i, )) for idx, i in enumerate(ready)]
-      sema = mp.Semaphore(min(int(mp.cpu_count() * self.__scaling_factor), len(ready)))
-      logging.info('Building %d images'%len(procs))
-      try:
-        for p in procs:
-          p.start()
-        for p in procs:
-          p.join()
-      finally:
-        for p in procs:
-          if p.is_alive():
-            p.terminate()
-      for i in ready:
-        built.add(str(i))
-        del to_build[str(i)]
-      ready = [i for i in to_build.values() if not i.parent or str(i.parent) in built or str(i.parent) in exist]
-    logging.info('Built %d images'%len(built))
-    return list(to_build.values())
-  
-  def _clean_up(self):
-    cli = docker.from_env()
-    cli.images.prune({'dangling': False})
-    os.system('rm -rf %s'%self.__build_dir)
\ No newline at end of file
+      seen = {str(i)}
+      while i.parent and str(i.parent) not in seen:
+        p = self.__to_build.get(str(i.parent))
+        if p is None:
+          break
+        rank = int(sum(l.size for l in p.layers)) + ranks[str(i)]
+        if rank <= ranks.get(str(p), 0):
+          break
+        ranks[str(p)] = rank
+        changed.add(str(p))
+        seen.add(str(p))
+        i = p
+    return changed
+
+
+def _build_image(args: Tuple[int, int, Image, List[Layer], str, str, str, ImageAssembler]
+                 ) -> Tuple[float, int, List[Tuple[str, float, int]], Tuple[int, float]]:
+  # returns the time taken, the bytes of the layers generated, the timings
+  # of the phases and the Docker API calls made with their latency
+  idx, total, image, new_layers, build_dir, layer_dir, registry, assembler = args
+  DockerClient.reset_stats()
+  timer = PhaseTimer()
+  start, n_bytes = timer.start(), 0
+  image_size = int(sum(l.size for l in image.layers))
+  if new_layers:
+    logging.info('[%d/%d] Generating %d layers of image %s, size: %s ...'%(idx, total, len(new_layers), image, 
+                 util.size(sum(l.size for l in new_layers))))
+    for l in new_layers:
+      _, written, samples = _build_layer((l, layer_dir, assembler))
+      n_bytes += written
+      timer.samples.extend(samples)
+  if assembler:
+    logging.info('[%d/%d] Pushing image %s and %d aliases to %s ...'%(idx, total, image, len(image.aliases), registry))
+    t = timer.start()
+    assembler.push(image)
+    timer.stop('push', t, image_size)
+    timer.stop('image', start, image_size)
+    return time.time() - start, n_bytes, timer.samples, DockerClient.stats()
+  logging.info('[%d/%d] Building image %s ...'%(idx, total, image))
+  t = timer.start()
+  image.build(build_dir, registry, _pool, layer_dir)
+  timer.stop('build', t, image_size)
+  logging.info('[%d/%d] Pushing image %s to %s ...'%(idx, total, image, registry))
+  t = timer.start()
+  image.push(registry)
+  timer.stop('push', t, image_size)
+  logging.info('[%d/%d] Deleting image %s ...'%(idx, total, image))
+  t = timer.start()
+  image.prune(registry)
+  timer.stop('prune', t)
+  if len(image.aliases) > 0:
+    logging.info('[%d/%d] Pushing %d aliases of %s to %s ...'%(idx, total, len(image.aliases), image, registry))
+    t = timer.start()
+    image.push_aliases(registry)
+    timer.stop('push_aliases', t)
+  timer.stop('image', start, image_size)
+  return time.time() - start, n_bytes, timer.samples, DockerClient.stats()
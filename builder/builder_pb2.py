@@ -1,11 +1,10 @@
+# -*- coding: utf-8 -*-
 # Generated by the protocol buffer compiler.  DO NOT EDIT!
 # source: builder.proto
-
-import sys
-_b=sys.version_info[0]<3 and (lambda x:x) or (lambda x:x.encode('latin1'))
+"""Generated protocol buffer code."""
+from google.protobuf.internal import builder as _builder
 from google.protobuf import descriptor as _descriptor
-from google.protobuf import message as _message
-from google.protobuf import reflection as _reflection
+from google.protobuf import descriptor_pool as _descriptor_pool
 from google.protobuf import symbol_database as _symbol_database
 # @@protoc_insertion_point(imports)
 
@@ -15,244 +14,29 @@ _sym_db = _symbol_database.Default()
 from google.protobuf import empty_pb2 as google_dot_protobuf_dot_empty__pb2
 
 
-DESCRIPTOR = _descriptor.FileDescriptor(
-  name='builder.proto',
-  package='dejavu.builder',
-  syntax='proto3',
-  serialized_options=None,
-  serialized_pb=_b('\n\rbuilder.proto\x12\x0e\x64\x65javu.builder\x1a\x1bgoogle/protobuf/empty.proto\"j\n\x05Image\x12\x0c\n\x04repo\x18\x01 \x01(\t\x12\x0b\n\x03tag\x18\x02 \x01(\t\x12\x0e\n\x06parent\x18\x03 \x01(\t\x12\x0f\n\x07\x61liases\x18\x04 \x03(\t\x12%\n\x06layers\x18\x05 \x03(\x0b\x32\x15.dejavu.builder.Layer\"%\n\x05Layer\x12\x0e\n\x06\x64igest\x18\x01 \x01(\t\x12\x0c\n\x04size\x18\x02 \x01(\x04\"6\n\rImageBuildSet\x12%\n\x06images\x18\x01 \x03(\x0b\x32\x15.dejavu.builder.Image\"\'\n\x11ImageBuildSummary\x12\x12\n\ntotal_size\x18\x01 \x01(\x04\x32\x96\x01\n\x0cImageBuilder\x12K\n\x05\x42uild\x12\x1d.dejavu.builder.ImageBuildSet\x1a!.dejavu.builder.ImageBuildSummary\"\x00\x12\x39\n\x05Purge\x12\x16.google.protobuf.Empty\x1a\x16.google.protobuf.Empty\"\x00\x62\x06proto3')
-  ,
-  dependencies=[google_dot_protobuf_dot_empty__pb2.DESCRIPTOR,])
-
-
-
-
-_IMAGE = _descriptor.Descriptor(
-  name='Image',
-  full_name='dejavu.builder.Image',
-  filename=None,
-  file=DESCRIPTOR,
-  containing_type=None,
-  fields=[
-    _descriptor.FieldDescriptor(
-      name='repo', full_name='dejavu.builder.Image.repo', index=0,
-      number=1, type=9, cpp_type=9, label=1,
-      has_default_value=False, default_value=_b("").decode('utf-8'),
-      message_type=None, enum_type=None, containing_type=None,
-      is_extension=False, extension_scope=None,
-      serialized_options=None, file=DESCRIPTOR),
-    _descriptor.FieldDescriptor(
-      name='tag', full_name='dejavu.builder.Image.tag', index=1,
-      number=2, type=9, cpp_type=9, label=1,
-      has_default_value=False, default_value=_b("").decode('utf-8'),
-      message_type=None, enum_type=None, containing_type=None,
-      is_extension=False, extension_scope=None,
-      serialized_options=None, file=DESCRIPTOR),
-    _descriptor.FieldDescriptor(
-      name='parent', full_name='dejavu.builder.Image.parent', index=2,
-      number=3, type=9, cpp_type=9, label=1,
-      has_default_value=False, default_value=_b("").decode('utf-8'),
-      message_type=None, enum_type=None, containing_type=None,
-      is_extension=False, extension_scope=None,
-      serialized_options=None, file=DESCRIPTOR),
-    _descriptor.FieldDescriptor(
-      name='aliases', full_name='dejavu.builder.Image.aliases', index=3,
-      number=4, type=9, cpp_type=9, label=3,
-      has_default_value=False, default_value=[],
-      message_type=None, enum_type=None, containing_type=None,
-      is_extension=False, extension_scope=None,
-      serialized_options=None, file=DESCRIPTOR),
-    _descriptor.FieldDescriptor(
-      name='layers', full_name='dejavu.builder.Image.layers', index=4,
-      number=5, type=11, cpp_type=10, label=3,
-      has_default_value=False, default_value=[],
-      message_type=None, enum_type=None, containing_type=None,
-      is_extension=False, extension_scope=None,
-      serialized_options=None, file=DESCRIPTOR),
-  ],
-  extensions=[
-  ],
-  nested_types=[],
-  enum_types=[
-  ],
-  serialized_options=None,
-  is_extendable=False,
-  syntax='proto3',
-  extension_ranges=[],
-  oneofs=[
-  ],
-  serialized_start=62,
-  serialized_end=168,
-)
-
-
-_LAYER = _descriptor.Descriptor(
-  name='Layer',
-  full_name='dejavu.builder.Layer',
-  filename=None,
-  file=DESCRIPTOR,
-  containing_type=None,
-  fields=[
-    _descriptor.FieldDescriptor(
-      name='digest', full_name='dejavu.builder.Layer.digest', index=0,
-      number=1, type=9, cpp_type=9, label=1,
-      has_default_value=False, default_value=_b("").decode('utf-8'),
-      message_type=None, enum_type=None, containing_type=None,
-      is_extension=False, extension_scope=None,
-      serialized_options=None, file=DESCRIPTOR),
-    _descriptor.FieldDescriptor(
-      name='size', full_name='dejavu.builder.Layer.size', index=1,
-      number=2, type=4, cpp_type=4, label=1,
-      has_default_value=False, default_value=0,
-      message_type=None, enum_type=None, containing_type=None,
-      is_extension=False, extension_scope=None,
-      serialized_options=None, file=DESCRIPTOR),
-  ],
-  extensions=[
-  ],
-  nested_types=[],
-  enum_types=[
-  ],
-  serialized_options=None,
-  is_extendable=False,
-  syntax='proto3',
-  extension_ranges=[],
-  oneofs=[
-  ],
-  serialized_start=170,
-  serialized_end=207,
-)
-
-
-_IMAGEBUILDSET = _descriptor.Descriptor(
-  name='ImageBuildSet',
-  full_name='dejavu.builder.ImageBuildSet',
-  filename=None,
-  file=DESCRIPTOR,
-  containing_type=None,
-  fields=[
-    _descriptor.FieldDescriptor(
-      name='images', full_name='dejavu.builder.ImageBuildSet.images', index=0,
-      number=1, type=11, cpp_type=10, label=3,
-      has_default_value=False, default_value=[],
-      message_type=None, enum_type=None, containing_type=None,
-      is_extension=False, extension_scope=None,
-      serialized_options=None, file=DESCRIPTOR),
-  ],
-  extensions=[
-  ],
-  nested_types=[],
-  enum_types=[
-  ],
-  serialized_options=None,
-  is_extendable=False,
-  syntax='proto3',
-  extension_ranges=[],
-  oneofs=[
-  ],
-  serialized_start=209,
-  serialized_end=263,
-)
-
-
-_IMAGEBUILDSUMMARY = _descriptor.Descriptor(
-  name='ImageBuildSummary',
-  full_name='dejavu.builder.ImageBuildSummary',
-  filename=None,
-  file=DESCRIPTOR,
-  containing_type=None,
-  fields=[
-    _descriptor.FieldDescriptor(
-      name='total_size', full_name='dejavu.builder.ImageBuildSummary.total_size', index=0,
-      number=1, type=4, cpp_type=4, label=1,
-      has_default_value=False, default_value=0,
-      message_type=None, enum_type=None, containing_type=None,
-      is_extension=False, extension_scope=None,
-      serialized_options=None, file=DESCRIPTOR),
-  ],
-  extensions=[
-  ],
-  nested_types=[],
-  enum_types=[
-  ],
-  serialized_options=None,
-  is_extendable=False,
-  syntax='proto3',
-  extension_ranges=[],
-  oneofs=[
-  ],
-  serialized_start=265,
-  serialized_end=304,
-)
-
-_IMAGE.fields_by_name['layers'].message_type = _LAYER
-_IMAGEBUILDSET.fields_by_name['images'].message_type = _IMAGE
-DESCRIPTOR.message_types_by_name['Image'] = _IMAGE
-DESCRIPTOR.message_types_by_name['Layer'] = _LAYER
-DESCRIPTOR.message_types_by_name['ImageBuildSet'] = _IMAGEBUILDSET
-DESCRIPTOR.message_types_by_name['ImageBuildSummary'] = _IMAGEBUILDSUMMARY
-_sym_db.RegisterFileDescriptor(DESCRIPTOR)
-
-Image = _reflection.GeneratedProtocolMessageType('Image', (_message.Message,), dict(
-  DESCRIPTOR = _IMAGE,
-  __module__ = 'builder_pb2'
-  # @@protoc_insertion_point(class_scope:dejavu.builder.Image)
-  ))
-_sym_db.RegisterMessage(Image)
-
-Layer = _reflection.GeneratedProtocolMessageType('Layer', (_message.Message,), dict(
-  DESCRIPTOR = _LAYER,
-  __module__ = 'builder_pb2'
-  # @@protoc_insertion_point(class_scope:dejavu.builder.Layer)
-  ))
-_sym_db.RegisterMessage(Layer)
-
-ImageBuildSet = _reflection.GeneratedProtocolMessageType('ImageBuildSet', (_message.Message,), dict(
-  DESCRIPTOR = _IMAGEBUILDSET,
-  __module__ = 'builder_pb2'
-  # @@protoc_insertion_point(class_scope:dejavu.builder.ImageBuildSet)
-  ))
-_sym_db.RegisterMessage(ImageBuildSet)
-
-ImageBuildSummary = _reflection.GeneratedProtocolMessageType('ImageBuildSummary', (_message.Message,), dict(
-  DESCRIPTOR = _IMAGEBUILDSUMMARY,
-  __module__ = 'builder_pb2'
-  # @@protoc_insertion_point(class_scope:dejavu.builder.ImageBuildSummary)
-  ))
-_sym_db.RegisterMessage(ImageBuildSummary)
-
-
-
-_IMAGEBUILDER = _descriptor.ServiceDescriptor(
-  name='ImageBuilder',
-  full_name='dejavu.builder.ImageBuilder',
-  file=DESCRIPTOR,
-  index=0,
-  serialized_options=None,
-  serialized_start=307,
-  serialized_end=457,
-  methods=[
-  _descriptor.MethodDescriptor(
-    name='Build',
-    full_name='dejavu.builder.ImageBuilder.Build',
-    index=0,
-    containing_service=None,
-    input_type=_IMAGEBUILDSET,
-    output_type=_IMAGEBUILDSUMMARY,
-    serialized_options=None,
-  ),
-  _descriptor.MethodDescriptor(
-    name='Purge',
-    full_name='dejavu.builder.ImageBuilder.Purge',
-    index=1,
-    containing_service=None,
-    input_type=google_dot_protobuf_dot_empty__pb2._EMPTY,
-    output_type=google_dot_protobuf_dot_empty__pb2._EMPTY,
-    serialized_options=None,
-  ),
-])
-_sym_db.RegisterServiceDescriptor(_IMAGEBUILDER)
-
-DESCRIPTOR.services_by_name['ImageBuilder'] = _IMAGEBUILDER
-
+DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\rbuilder.proto\x12\x0e\x64\x65javu.builder\x1a\x1bgoogle/protobuf/empty.proto\"j\n\x05Image\x12\x0c\n\x04repo\x18\x01 \x01(\t\x12\x0b\n\x03tag\x18\x02 \x01(\t\x12\x0e\n\x06parent\x18\x03 \x01(\t\x12\x0f\n\x07\x61liases\x18\x04 \x03(\t\x12%\n\x06layers\x18\x05 \x03(\x0b\x32\x15.dejavu.builder.Layer\"%\n\x05Layer\x12\x0e\n\x06\x64igest\x18\x01 \x01(\t\x12\x0c\n\x04size\x18\x02 \x01(\x04\"6\n\rImageBuildSet\x12%\n\x06images\x18\x01 \x03(\x0b\x32\x15.dejavu.builder.Image\"y\n\x0cPhaseSummary\x12\x0c\n\x04name\x18\x01 \x01(\t\x12\r\n\x05\x63ount\x18\x02 \x01(\x04\x12\x15\n\rtotal_seconds\x18\x03 \x01(\x01\x12\x13\n\x0bmax_seconds\x18\x04 \x01(\x01\x12\r\n\x05\x62ytes\x18\x05 \x01(\x04\x12\x11\n\thistogram\x18\x06 \x03(\x04\"\xe1\x01\n\x11ImageBuildSummary\x12\x12\n\ntotal_size\x18\x01 \x01(\x04\x12\x10\n\x08\x64uration\x18\x02 \x01(\x01\x12\x14\n\x0cimages_built\x18\x03 \x01(\x04\x12\x15\n\rimages_failed\x18\x04 \x01(\x04\x12\x18\n\x10\x64ocker_api_calls\x18\x05 \x01(\x04\x12\x1a\n\x12\x64ocker_api_seconds\x18\x06 \x01(\x01\x12\x15\n\rbucket_bounds\x18\x07 \x03(\x01\x12,\n\x06phases\x18\x08 \x03(\x0b\x32\x1c.dejavu.builder.PhaseSummary\"\x16\n\x08\x42uildJob\x12\n\n\x02id\x18\x01 \x01(\t\"\xd0\x02\n\nBuildEvent\x12\x0e\n\x06job_id\x18\x01 \x01(\t\x12-\n\x04kind\x18\x02 \x01(\x0e\x32\x1f.dejavu.builder.BuildEvent.Kind\x12\x11\n\ttimestamp\x18\x03 \x01(\x01\x12\r\n\x05image\x18\x04 \x01(\t\x12\r\n\x05layer\x18\x05 \x01(\t\x12\r\n\x05\x62ytes\x18\x06 \x01(\x04\x12\x10\n\x08\x64uration\x18\x07 \x01(\x01\x12\r\n\x05\x65rror\x18\x08 \x01(\t\x12\x32\n\x07summary\x18\t \x01(\x0b\x32!.dejavu.builder.ImageBuildSummary\"n\n\x04Kind\x12\n\n\x06QUEUED\x10\x00\x12\x0b\n\x07STARTED\x10\x01\x12\x0f\n\x0bLAYER_BUILT\x10\x02\x12\x10\n\x0cIMAGE_PUSHED\x10\x03\x12\x10\n\x0cIMAGE_FAILED\x10\x04\x12\x0c\n\x08\x46INISHED\x10\x05\x12\n\n\x06\x46\x41ILED\x10\x06\x32\xb1\x03\n\x0cImageBuilder\x12K\n\x05\x42uild\x12\x1d.dejavu.builder.ImageBuildSet\x1a!.dejavu.builder.ImageBuildSummary\"\x00\x12S\n\x0b\x42uildStream\x12\x1d.dejavu.builder.ImageBuildSet\x1a!.dejavu.builder.ImageBuildSummary\"\x00(\x01\x12\x43\n\x06Submit\x12\x1d.dejavu.builder.ImageBuildSet\x1a\x18.dejavu.builder.BuildJob\"\x00\x12\x41\n\x05Watch\x12\x18.dejavu.builder.BuildJob\x1a\x1a.dejavu.builder.BuildEvent\"\x00\x30\x01\x12<\n\x06\x43\x61ncel\x12\x18.dejavu.builder.BuildJob\x1a\x16.google.protobuf.Empty\"\x00\x12\x39\n\x05Purge\x12\x16.google.protobuf.Empty\x1a\x16.google.protobuf.Empty\"\x00\x62\x06proto3')
+
+_builder.BuildMessageAndEnumDescriptors(DESCRIPTOR, globals())
+_builder.BuildTopDescriptorsAndMessages(DESCRIPTOR, 'builder_pb2', globals())
+if _descriptor._USE_C_DESCRIPTORS == False:
+
+  DESCRIPTOR._options = None
+  _IMAGE._serialized_start=62
+  _IMAGE._serialized_end=168
+  _LAYER._serialized_start=170
+  _LAYER._serialized_end=207
+  _IMAGEBUILDSET._serialized_start=209
+  _IMAGEBUILDSET._serialized_end=263
+  _PHASESUMMARY._serialized_start=265
+  _PHASESUMMARY._serialized_end=386
+  _IMAGEBUILDSUMMARY._serialized_start=389
+  _IMAGEBUILDSUMMARY._serialized_end=614
+  _BUILDJOB._serialized_start=616
+  _BUILDJOB._serialized_end=638
+  _BUILDEVENT._serialized_start=641
+  _BUILDEVENT._serialized_end=977
+  _BUILDEVENT_KIND._serialized_start=867
+  _BUILDEVENT_KIND._serialized_end=977
+  _IMAGEBUILDER._serialized_start=980
+  _IMAGEBUILDER._serialized_end=1413
 # @@protoc_insertion_point(module_scope)
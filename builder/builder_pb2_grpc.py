@@ -21,6 +21,26 @@ class ImageBuilderStub(object):
         request_serializer=builder__pb2.ImageBuildSet.SerializeToString,
         response_deserializer=builder__pb2.ImageBuildSummary.FromString,
         )
+    self.BuildStream = channel.stream_unary(
+        '/dejavu.builder.ImageBuilder/BuildStream',
+        request_serializer=builder__pb2.ImageBuildSet.SerializeToString,
+        response_deserializer=builder__pb2.ImageBuildSummary.FromString,
+        )
+    self.Submit = channel.unary_unary(
+        '/dejavu.builder.ImageBuilder/Submit',
+        request_serializer=builder__pb2.ImageBuildSet.SerializeToString,
+        response_deserializer=builder__pb2.BuildJob.FromString,
+        )
+    self.Watch = channel.unary_stream(
+        '/dejavu.builder.ImageBuilder/Watch',
+        request_serializer=builder__pb2.BuildJob.SerializeToString,
+        response_deserializer=builder__pb2.BuildEvent.FromString,
+        )
+    self.Cancel = channel.unary_unary(
+        '/dejavu.builder.ImageBuilder/Cancel',
+        request_serializer=builder__pb2.BuildJob.SerializeToString,
+        response_deserializer=google_dot_protobuf_dot_empty__pb2.Empty.FromString,
+        )
     self.Purge = channel.unary_unary(
         '/dejavu.builder.ImageBuilder/Purge',
         request_serializer=google_dot_protobuf_dot_empty__pb2.Empty.SerializeToString,
@@ -41,6 +61,41 @@ class ImageBuilderServicer(object):
     context.set_details('Method not implemented!')
     raise NotImplementedError('Method not implemented!')
 
+  def BuildStream(self, request_iterator, context):
+    """BuildStream builds and publishes images streamed in chunks of 
+    ImageBuildSet in their dependency order, which are built as they arrive.
+    The job ID is sent in the initial metadata as job-id, and a summary of 
+    the image building is returned
+    """
+    context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+    context.set_details('Method not implemented!')
+    raise NotImplementedError('Method not implemented!')
+
+  def Submit(self, request, context):
+    """Submit queues the images specified in the ImageBuildSet to be built as 
+    a job, and returns the job without waiting for the build
+    """
+    context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+    context.set_details('Method not implemented!')
+    raise NotImplementedError('Method not implemented!')
+
+  def Watch(self, request, context):
+    """Watch streams the progress events of a job since its submission, until
+    the job is finished or fails
+    """
+    context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+    context.set_details('Method not implemented!')
+    raise NotImplementedError('Method not implemented!')
+
+  def Cancel(self, request, context):
+    """Cancel cancels a job, which builds no more images and fails once the 
+    images being built are done. The builds of Build and BuildStream are 
+    also cancelled when their calls are cancelled or time out
+    """
+    context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+    context.set_details('Method not implemented!')
+    raise NotImplementedError('Method not implemented!')
+
   def Purge(self, request, context):
     """Purge purges both the manifests and blobs in the registry behind. 
     """
@@ -56,6 +111,26 @@ def add_ImageBuilderServicer_to_server(servicer, server):
           request_deserializer=builder__pb2.ImageBuildSet.FromString,
           response_serializer=builder__pb2.ImageBuildSummary.SerializeToString,
       ),
+      'BuildStream': grpc.stream_unary_rpc_method_handler(
+          servicer.BuildStream,
+          request_deserializer=builder__pb2.ImageBuildSet.FromString,
+          response_serializer=builder__pb2.ImageBuildSummary.SerializeToString,
+      ),
+      'Submit': grpc.unary_unary_rpc_method_handler(
+          servicer.Submit,
+          request_deserializer=builder__pb2.ImageBuildSet.FromString,
+          response_serializer=builder__pb2.BuildJob.SerializeToString,
+      ),
+      'Watch': grpc.unary_stream_rpc_method_handler(
+          servicer.Watch,
+          request_deserializer=builder__pb2.BuildJob.FromString,
+          response_serializer=builder__pb2.BuildEvent.SerializeToString,
+      ),
+      'Cancel': grpc.unary_unary_rpc_method_handler(
+          servicer.Cancel,
+          request_deserializer=builder__pb2.BuildJob.FromString,
+          response_serializer=google_dot_protobuf_dot_empty__pb2.Empty.SerializeToString,
+      ),
       'Purge': grpc.unary_unary_rpc_method_handler(
           servicer.Purge,
           request_deserializer=google_dot_protobuf_dot_empty__pb2.Empty.FromString,
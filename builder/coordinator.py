@@ -0,0 +1,360 @@
+import os
+import sys
+
+module_dir = '/'.join(os.path.abspath(os.path.dirname(__file__)).split('/')[:-1])
+sys.path.append(module_dir)
+
+import time
+import grpc
+import uuid
+import logging
+import argparse
+import threading
+
+from concurrent import futures
+from typing import Generator, Iterable, List, Set, Tuple
+from google.protobuf import empty_pb2
+
+import util
+import builder.builder_pb2 as pb2
+import builder.builder_pb2_grpc as builder_grpc
+
+from builder.stats import merge_summaries, log_summary, write_report
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# maximum size in bytes of the build sets streamed to and from the 
+# coordinator, well below the default message size limit of gRPC (4MB)
+MAX_CHUNK_SIZE = 2 ** 20
+
+
+def _layer_bytes(images: Iterable[pb2.Image], excluded: Set[str]=frozenset()) -> int:
+  # the size of the unique layers of the images, except the excluded ones
+  layers = {l.digest: l.size for i in images for l in i.layers if l.digest not in excluded}
+  return int(sum(layers.values()))
+
+
+def chunk_build_set(images: Iterable[pb2.Image], max_size: int=MAX_CHUNK_SIZE) -> Generator[pb2.ImageBuildSet, None, None]:
+  # splits the images into the build sets of at most the maximum size each, 
+  # unless an image is larger by itself, in the order of the images
+  chunk, size = [], 0
+  for i in images:
+    n = i.ByteSize()
+    if chunk and size + n > max_size:
+      yield pb2.ImageBuildSet(images=chunk)
+      chunk, size = [], 0
+    chunk += i,
+    size += n
+  if chunk:
+    yield pb2.ImageBuildSet(images=chunk)
+
+
+class Shard:
+
+  # A parent-closed subset of the images to build: the parent of every image
+  # is either in the same shard or not to be built, and the images sharing
+  # tags or aliases are in the same shard
+
+  def __init__(self, shard_id: int):
+    self.__id = shard_id
+    self.__images = []
+    self.__digests = set()
+    self.__size = 0
+    self.__attempts = 0
+    self.__last_node = None
+
+  @property
+  def id(self) -> int:
+    return self.__id
+
+  @property
+  def images(self) -> List[pb2.Image]:
+    return self.__images
+
+  @property
+  def size(self) -> int:
+    # total size of the unique layers of the shard
+    return self.__size
+
+  @property
+  def attempts(self) -> int:
+    return self.__attempts
+
+  @property
+  def last_node(self) -> str:
+    return self.__last_node
+
+  def new_bytes(self, images: Iterable[pb2.Image]) -> int:
+    # the size of the layers the images would add to the shard
+    return _layer_bytes(images, self.__digests)
+
+  def add(self, images: Iterable[pb2.Image]):
+    for i in images:
+      self.__images += i,
+      for l in i.layers:
+        if l.digest not in self.__digests:
+          self.__digests.add(l.digest)
+          self.__size += l.size
+
+  def attempted(self, node: str):
+    self.__attempts += 1
+    self.__last_node = node
+
+  def ordered(self) -> List[pb2.Image]:
+    # the images with the parents before their children, as the builders 
+    # take the streamed images in the dependency order
+    refs = {a: i for i in self.__images for a in ['%s:%s'%(i.repo, i.tag)] + list(i.aliases)}
+    ordered, seen = [], set()
+    for i in self.__images:
+      chain = []
+      while i is not None and id(i) not in seen:
+        seen.add(id(i))
+        chain += i,
+        i = refs.get(i.parent)
+      ordered.extend(reversed(chain))
+    return ordered
+
+  def to_build_sets(self) -> Generator[pb2.ImageBuildSet, None, None]:
+    return chunk_build_set(self.ordered())
+
+  def __str__(self) -> str:
+    return 'shard %d'%self.id
+
+
+class Coordinator:
+
+  # Builds the images on multiple builders in parallel: the image set is
+  # partitioned into the subtrees of the image DAG, which are packed into
+  # shards balanced by their layer bytes, with the subtrees sharing layers
+  # packed together where possible. Every builder takes the largest shard
+  # left once it is done with its previous one, and the shards failing on a
+  # builder are dispatched again, preferably to another builder, up to the
+  # maximum number of attempts. The shards are streamed to the builders in 
+  # chunks, so that no message exceeds the size limit of gRPC. Builders 
+  # failing to respond are not given any more shards, while a shard timed 
+  # out is cancelled on its builder before dispatched again, so that it is 
+  # not built twice at the same time
+
+  def __init__(self, nodes: List[str], shards_per_node: int=4, max_attempts: int=3, timeout: float=None):
+    self.__nodes = nodes
+    self.__shards_per_node = shards_per_node
+    self.__max_attempts = max_attempts
+    self.__timeout = timeout
+    self.__stubs = {n: builder_grpc.ImageBuilderStub(grpc.insecure_channel(n)) for n in nodes}
+
+  @property
+  def nodes(self) -> List[str]:
+    return self.__nodes
+
+  def build(self, bs: pb2.ImageBuildSet) -> pb2.ImageBuildSummary:
+    start = time.time()
+    shards = self._partition(bs.images)
+    summaries, failed = self._dispatch(shards)
+    summary = merge_summaries(summaries, time.time() - start)
+    summary.images_failed += sum(len(s.images) for s in failed)
+    if failed:
+      logging.error('Failed to build %d shards of %d images'%(len(failed), sum(len(s.images) for s in failed)))
+    log_summary(summary)
+    return summary
+
+  def purge(self):
+    for n, stub in self.__stubs.items():
+      logging.info('Purging the registry of %s ...'%n)
+      stub.Purge(empty_pb2.Empty())
+
+  def _partition(self, images: List[pb2.Image]) -> List[Shard]:
+    # the images are grouped with their parents and the images sharing their
+    # tags or aliases, and the groups are packed into the shards largest first,
+    # each into the shard that is the smallest with the layers it adds
+    parents = list(range(len(images)))
+
+    def _find(i: int) -> int:
+      while parents[i] != i:
+        parents[i] = parents[parents[i]]
+        i = parents[i]
+      return i
+
+    def _union(i: int, j: int):
+      parents[_find(i)] = _find(j)
+
+    refs = {}
+    for idx, i in enumerate(images):
+      for a in ['%s:%s'%(i.repo, i.tag)] + list(i.aliases):
+        if a in refs:
+          _union(idx, refs[a])
+        refs[a] = idx
+    for idx, i in enumerate(images):
+      if i.parent in refs:
+        _union(idx, refs[i.parent])
+    groups = {}
+    for idx, i in enumerate(images):
+      groups.setdefault(_find(idx), []).append(i)
+    groups = sorted(groups.values(), key=_layer_bytes, reverse=True)
+
+    n_shards = max(1, min(len(groups), len(self.__nodes) * self.__shards_per_node))
+    shards = [Shard(k) for k in range(n_shards)]
+    for g in groups:
+      s = min(shards, key=lambda s: s.size + s.new_bytes(g))
+      s.add(g)
+    shards = sorted((s for s in shards if s.images), key=lambda s: s.size, reverse=True)
+    logging.info('Partitioned %d images into %d groups and %d shards, largest: %s, smallest: %s'%(len(images),
+                 len(groups), len(shards), util.size(shards[0].size) if shards else '-',
+                 util.size(shards[-1].size) if shards else '-'))
+    return shards
+
+  def _cancel(self, node: str, job_id: str) -> bool:
+    # cancels the job of a shard on the builder and waits until it is done, 
+    # returning whether the builder is done with the shard in time
+    stub, job = self.__stubs[node], pb2.BuildJob(id=job_id)
+    logging.info('Cancelling job %s on %s ...'%(job_id, node))
+    try:
+      stub.Cancel(job, timeout=self.__timeout)
+      for _ in stub.Watch(job, timeout=self.__timeout):
+        pass
+    except grpc.RpcError as e:
+      if e.code() == grpc.StatusCode.NOT_FOUND:
+        return True
+      logging.warning('Failed to cancel job %s on %s: %s %s'%(job_id, node, e.code(), e.details()))
+      return False
+    return True
+
+  def _dispatch(self, shards: List[Shard]) -> Tuple[List[pb2.ImageBuildSummary], List[Shard]]:
+    # every builder is served by a thread taking the shards off the queue
+    # kept in the descending order of the shard sizes
+    queue, summaries, failed = list(shards), [], []
+    alive, cond = set(self.__nodes), threading.Condition()
+    n_left = [len(shards)]
+
+    def _take(node: str) -> Shard:
+      with cond:
+        while not queue and n_left[0] > 0:
+          cond.wait()
+        if n_left[0] == 0:
+          return None
+        # a shard failing on the builder is left to the others if possible
+        s = next((s for s in queue if s.last_node != node), queue[0])
+        queue.remove(s)
+        s.attempted(node)
+        return s
+
+    def _work(node: str):
+      stub = self.__stubs[node]
+      while True:
+        s = _take(node)
+        if s is None:
+          return
+        logging.info('Dispatching %s of %d images, size: %s, to %s, attempt: %d ...'%(s, len(s.images),
+                     util.size(s.size), node, s.attempts))
+        call = stub.BuildStream.future(s.to_build_sets(), timeout=self.__timeout)
+        try:
+          summary = call.result()
+        except grpc.RpcError as e:
+          logging.error('Failed to build %s on %s: %s %s'%(s, node, e.code(), e.details()))
+          # the builder is considered down if it fails to respond, or the 
+          # shard timed out on it cannot be cancelled
+          node_down = e.code() == grpc.StatusCode.UNAVAILABLE
+          if e.code() == grpc.StatusCode.DEADLINE_EXCEEDED:
+            job_id = dict(call.initial_metadata() or ()).get('job-id')
+            node_down = not job_id or not self._cancel(node, job_id)
+          with cond:
+            if node_down:
+              alive.discard(node)
+            if s.attempts < self.__max_attempts and alive:
+              queue.append(s)
+              queue.sort(key=lambda x: x.size, reverse=True)
+            else:
+              failed.append(s)
+              n_left[0] -= 1
+            if not alive:
+              logging.error('All builders are down, giving up %d shards'%len(queue))
+              failed.extend(queue)
+              n_left[0] -= len(queue)
+              queue.clear()
+            cond.notify_all()
+          if node_down:
+            logging.warning('Builder %s is down, %d builders left'%(node, len(alive)))
+            return
+          continue
+        logging.info('Built %s on %s, images: %d, failed: %d, duration: %.3fs'%(s, node, summary.images_built,
+                     summary.images_failed, summary.duration))
+        with cond:
+          summaries.append(summary)
+          n_left[0] -= 1
+          cond.notify_all()
+
+    workers = [threading.Thread(target=_work, args=(n, ), daemon=True) for n in self.__nodes]
+    for w in workers:
+      w.start()
+    for w in workers:
+      w.join()
+    return summaries, failed
+
+
+class CoordinatorServicer(builder_grpc.ImageBuilderServicer):
+
+  # Serves the builds of the image builder service on multiple builders. The
+  # builds are run one at a time, as every build occupies all the builders. 
+  # The streamed build sets are taken as a whole to be partitioned
+
+  def __init__(self, coordinator: Coordinator, args: argparse.Namespace):
+    self.__coordinator = coordinator
+    self.__args = args
+    self.__lock = threading.Lock()
+
+  def Build(self, bs: pb2.ImageBuildSet, context) -> pb2.ImageBuildSummary:
+    return self._build(bs)
+
+  def BuildStream(self, bss: Iterable[pb2.ImageBuildSet], context) -> pb2.ImageBuildSummary:
+    return self._build(pb2.ImageBuildSet(images=[i for bs in bss for i in bs.images]))
+
+  def Purge(self, empty: empty_pb2.Empty, context) -> empty_pb2.Empty:
+    self.__coordinator.purge()
+    return empty
+
+  def _build(self, bs: pb2.ImageBuildSet) -> pb2.ImageBuildSummary:
+    build_id = uuid.uuid4().hex
+    with self.__lock:
+      logging.info('Starting build %s of %d images ...'%(build_id, len(bs.images)))
+      summary = self.__coordinator.build(bs)
+    if self.__args.report_dir:
+      write_report('%s/%s.json'%(self.__args.report_dir, build_id), build_id, summary)
+    return summary
+
+
+def parse_args() -> argparse.Namespace:
+  parser = argparse.ArgumentParser(description='Coordinator of Docker image builder GRPC services')
+  parser.add_argument('--port', type=int, default=54999, dest='port',
+                      help='Listening port')
+  parser.add_argument('--builders', type=str, nargs='+', required=True, dest='builders',
+                      help='Addresses (host:port) of the image builder services')
+  parser.add_argument('--shards-per-builder', type=int, default=4, dest='shards_per_builder',
+                      help='Number of shards of the images per builder. More shards balance the load '
+                           'better and lose less work on failures, while fewer shards share more layers')
+  parser.add_argument('--max-attempts', type=int, default=3, dest='max_attempts',
+                      help='Maximum number of times a shard is dispatched')
+  parser.add_argument('--shard-timeout', type=float, default=None, dest='shard_timeout',
+                      help='Timeout in seconds of building a shard, after which the shard is '
+                           'cancelled on the builder and dispatched again. No timeout if not set')
+  parser.add_argument('--report-dir', type=str, default=None, dest='report_dir',
+                      help='Directory of the JSON reports of the builds')
+  return parser.parse_args()
+
+
+def serve(args: argparse.Namespace):
+  coordinator = Coordinator(args.builders, args.shards_per_builder, args.max_attempts, args.shard_timeout)
+  if args.report_dir:
+    os.makedirs(args.report_dir, exist_ok=True)
+  server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
+  builder_grpc.add_ImageBuilderServicer_to_server(CoordinatorServicer(coordinator, args), server)
+  server.add_insecure_port('[::]:%d'%args.port)
+  server.start()
+  logging.info('Image builder coordinator of %d builders is listening at %d ...'%(len(args.builders), args.port))
+  try:
+    while True:
+      time.sleep(24 * 60 * 60)
+  except:
+    server.stop(0)
+
+if __name__ == "__main__":
+  serve(parse_args())
@@ -0,0 +1,154 @@
+import time
+import uuid
+import queue
+import logging
+import threading
+
+from collections import OrderedDict
+from typing import Callable, Generator, Iterable, Union
+
+import builder.builder_pb2 as pb2
+
+
+MAX_FINISHED_JOBS = 100
+
+# the kinds of the events a job drops once it is done and no one is watching
+# it, which are covered by the summary of the job
+TRANSIENT_EVENTS = (pb2.BuildEvent.LAYER_BUILT, )
+
+
+class Job:
+
+  # A build job recording its progress events, which can be watched from
+  # other threads while the job runs. The build set is either a message or 
+  # a stream of messages. A cancelled job builds no more images. A finished 
+  # job keeps neither the build set nor the transient events
+
+  def __init__(self, job_id: str, build_set: Union[pb2.ImageBuildSet, Iterable[pb2.ImageBuildSet]]):
+    self.__id = job_id
+    self.__build_set = build_set
+    self.__streamed = not isinstance(build_set, pb2.ImageBuildSet)
+    self.__events = []
+    self.__watchers = 0
+    self.__compacted = False
+    self.__done = False
+    self.__cancelled = threading.Event()
+    self.__cond = threading.Condition()
+
+  @property
+  def id(self) -> str:
+    return self.__id
+
+  @property
+  def build_set(self) -> Union[pb2.ImageBuildSet, Iterable[pb2.ImageBuildSet]]:
+    return self.__build_set
+
+  @property
+  def streamed(self) -> bool:
+    return self.__streamed
+
+  @property
+  def done(self) -> bool:
+    return self.__done
+
+  @property
+  def cancelled(self) -> threading.Event:
+    return self.__cancelled
+
+  def cancel(self):
+    if not self.__done and not self.__cancelled.is_set():
+      logging.info('Cancelling job %s ...'%self.id)
+    self.__cancelled.set()
+
+  def publish(self, event: pb2.BuildEvent):
+    event.job_id = self.id
+    if not event.timestamp:
+      event.timestamp = time.time()
+    with self.__cond:
+      self.__events += event,
+      self.__done = event.kind in (pb2.BuildEvent.FINISHED, pb2.BuildEvent.FAILED)
+      if self.__done:
+        self.__build_set = None
+        self._compact()
+      self.__cond.notify_all()
+
+  def watch(self, timeout: float=None) -> Generator[pb2.BuildEvent, None, None]:
+    # yields the events from the submission of the job until it is done, and
+    # None whenever no event comes within the timeout
+    idx = 0
+    with self.__cond:
+      self.__watchers += 1
+    try:
+      while True:
+        with self.__cond:
+          if idx == len(self.__events) and not self.__done:
+            self.__cond.wait(timeout)
+          events, done = self.__events[idx:], self.__done
+        if not events and not done:
+          yield None
+        for e in events:
+          yield e
+        idx += len(events)
+        if done:
+          return
+    finally:
+      with self.__cond:
+        self.__watchers -= 1
+        self._compact()
+
+  def _compact(self):
+    # drops the transient events once the job is done, unless it is being
+    # watched, as the watchers keep their positions in the events
+    if self.__done and self.__watchers == 0 and not self.__compacted:
+      self.__events = [e for e in self.__events if e.kind not in TRANSIENT_EVENTS]
+      self.__compacted = True
+
+
+class JobQueue:
+
+  # Runs the submitted jobs in the order of submission with a fixed number
+  # of worker threads. The finished jobs are kept for watching, up to
+  # MAX_FINISHED_JOBS of them
+
+  def __init__(self, run: Callable[[Job], pb2.ImageBuildSummary], n_workers: int=1):
+    self.__run = run
+    self.__queue = queue.Queue()
+    self.__jobs = OrderedDict()
+    self.__lock = threading.Lock()
+    for _ in range(n_workers):
+      threading.Thread(target=self._work, daemon=True).start()
+
+  def submit(self, build_set: Union[pb2.ImageBuildSet, Iterable[pb2.ImageBuildSet]]) -> Job:
+    job = Job(uuid.uuid4().hex, build_set)
+    with self.__lock:
+      self.__jobs[job.id] = job
+      finished = [j for j in self.__jobs.values() if j.done]
+      for j in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+        del self.__jobs[j.id]
+    job.publish(pb2.BuildEvent(kind=pb2.BuildEvent.QUEUED))
+    self.__queue.put(job)
+    if job.streamed:
+      logging.info('Queued job %s of streamed images'%job.id)
+    else:
+      logging.info('Queued job %s of %d images'%(job.id, len(build_set.images)))
+    return job
+
+  def get(self, job_id: str) -> Job:
+    with self.__lock:
+      return self.__jobs.get(job_id)
+
+  def _work(self):
+    while True:
+      job = self.__queue.get()
+      if job.cancelled.is_set():
+        job.publish(pb2.BuildEvent(kind=pb2.BuildEvent.FAILED, error='Job %s is cancelled'%job.id))
+        continue
+      logging.info('Starting job %s ...'%job.id)
+      job.publish(pb2.BuildEvent(kind=pb2.BuildEvent.STARTED))
+      try:
+        summary = self.__run(job)
+        job.publish(pb2.BuildEvent(kind=pb2.BuildEvent.FINISHED, summary=summary))
+        logging.info('Finished job %s'%job.id)
+      except Exception as e:
+        logging.exception('Job %s failed'%job.id)
+        job.publish(pb2.BuildEvent(kind=pb2.BuildEvent.FAILED, error=str(e)))
@@ -0,0 +1,185 @@
+import os
+import gzip
+import json
+import hashlib
+import logging
+import tarfile
+
+from typing import Dict, List, Tuple
+
+import util
+
+from base import Image, Layer, LAYER_CHUNK_SIZE
+from builder.registry import RegistryClient, MANIFEST_V2_TYPE
+
+
+CONFIG_TYPE = 'application/vnd.docker.container.image.v1+json'
+LAYER_TYPE = 'application/vnd.docker.image.rootfs.diff.tar.gzip'
+# the default compression level of docker push
+COMPRESS_LEVEL = 6
+
+
+class _DigestWriter:
+
+  # forwards the written bytes to the underlying file while computing their
+  # digest and size
+
+  def __init__(self, f):
+    self.__f = f
+    self.__sha = hashlib.sha256()
+    self.__size = 0
+
+  @property
+  def digest(self) -> str:
+    return 'sha256:%s'%self.__sha.hexdigest()
+
+  @property
+  def size(self) -> int:
+    return self.__size
+
+  def write(self, b: bytes) -> int:
+    self.__sha.update(b)
+    self.__size += len(b)
+    return self.__f.write(b)
+
+  def flush(self):
+    self.__f.flush()
+
+
+class LayerBlob:
+
+  def __init__(self, path: str, dgst: str, size: int, diff_id: str):
+    self.__path = path
+    self.__dgst = dgst
+    self.__size = size
+    self.__diff_id = diff_id
+
+  @property
+  def path(self) -> str:
+    return self.__path
+
+  @property
+  def digest(self) -> str:
+    return self.__dgst
+
+  @property
+  def size(self) -> int:
+    return self.__size
+
+  @property
+  def diff_id(self) -> str:
+    return self.__diff_id
+
+  def to_json(self) -> Dict[str, object]:
+    return {
+      'digest': self.digest,
+      'size': self.size,
+      'diff_id': self.diff_id,
+    }
+
+
+class ImageAssembler:
+
+  # Assembles the images without the Docker daemon: every layer is packed
+  # once into a gzipped tar holding the layer file, as `COPY <digest> /<digest>`
+  # does, and the images are pushed to the registry as schema 2 manifests
+  # referring to the layer blobs, with the parent layers on the bottom
+
+  def __init__(self, build_dir: str, registry: str):
+    self.__build_dir = build_dir
+    self.__registry = registry
+    self.__client = None
+
+  @property
+  def client(self) -> RegistryClient:
+    # the HTTP session is created lazily in every process
+    if self.__client is None or self.__client[0] != os.getpid():
+      self.__client = (os.getpid(), RegistryClient(self.__registry))
+    return self.__client[1]
+
+  def __getstate__(self):
+    # the HTTP session is not shared with the worker processes
+    return dict(self.__dict__, _ImageAssembler__client=None)
+
+  def pack(self, layer: Layer) -> LayerBlob:
+    base = '%s/blob'%self.__build_dir
+    os.makedirs(base, exist_ok=True)
+    blob_f, meta_f = '%s/%s'%(base, layer.digest), '%s/%s.json'%(base, layer.digest)
+    if os.path.exists(meta_f):
+      return self.load_blob(layer)
+    logging.debug('Packing layer %s, size: %s ...'%(layer.digest, util.size(layer.size)))
+    layer_f = '%s/layer/%s'%(self.__build_dir, layer.digest)
+    tmp_f = '%s.%d.tmp'%(blob_f, os.getpid())
+    with open(tmp_f, 'wb') as f:
+      blob_w = _DigestWriter(f)
+      with gzip.GzipFile(filename='', mode='wb', fileobj=blob_w, compresslevel=COMPRESS_LEVEL, mtime=0) as gz:
+        tar_w = _DigestWriter(gz)
+        with tarfile.open(fileobj=tar_w, mode='w|', bufsize=LAYER_CHUNK_SIZE) as tar, open(layer_f, 'rb') as lf:
+          info = tar.gettarinfo(arcname=layer.digest, fileobj=lf)
+          info.mode, info.mtime, info.uid, info.gid, info.uname, info.gname = 0o644, 0, 0, 0, '', ''
+          tar.addfile(info, lf)
+    os.replace(tmp_f, blob_f)
+    blob = LayerBlob(blob_f, blob_w.digest, blob_w.size, tar_w.digest)
+    with open('%s.%d.tmp'%(meta_f, os.getpid()), 'w') as f:
+      json.dump(blob.to_json(), f)
+    os.replace('%s.%d.tmp'%(meta_f, os.getpid()), meta_f)
+    return blob
+
+  def load_blob(self, layer: Layer) -> LayerBlob:
+    blob_f = '%s/blob/%s'%(self.__build_dir, layer.digest)
+    with open('%s.json'%blob_f) as f:
+      meta = json.load(f)
+    return LayerBlob(blob_f, meta['digest'], meta['size'], meta['diff_id'])
+
+  def push(self, image: Image):
+    cli = self.client
+    layers, config = self._base(image)
+    for l in image.layers:
+      blob = self.load_blob(l)
+      with open(blob.path, 'rb') as f:
+        cli.push_blob(image.repo, blob.digest, f, blob.size)
+      layers += {'mediaType': LAYER_TYPE, 'size': blob.size, 'digest': blob.digest},
+      config['rootfs']['diff_ids'] += blob.diff_id,
+      config['history'] += {'created_by': 'COPY %s /%s'%(l.digest, l.digest)},
+    config = json.dumps(config, separators=(',', ':')).encode('utf-8')
+    config_dgst = 'sha256:%s'%hashlib.sha256(config).hexdigest()
+    cli.push_blob(image.repo, config_dgst, config, len(config))
+    manifest = json.dumps({
+      'schemaVersion': 2,
+      'mediaType': MANIFEST_V2_TYPE,
+      'config': {'mediaType': CONFIG_TYPE, 'size': len(config), 'digest': config_dgst},
+      'layers': layers,
+    }, indent=3).encode('utf-8')
+    cli.put_manifest(image.repo, image.tag, manifest)
+    # the blobs of the aliases in other repos are mounted from the image repo
+    for a in image.aliases:
+      repo, tag = a.split(':')
+      for dgst in [l['digest'] for l in layers] + [config_dgst]:
+        self._mount(repo, dgst, image.repo)
+      cli.put_manifest(repo, tag, manifest)
+
+  def _mount(self, repo: str, dgst: str, mount_from: str):
+    if not self.client.mount_blob(repo, dgst, mount_from):
+      raise RuntimeError('Failed to mount blob %s from %s to %s'%(dgst, mount_from, repo))
+
+  def _base(self, image: Image) -> Tuple[List[Dict[str, object]], Dict[str, object]]:
+    # the layers and the config of the parent image, whose blobs are mounted
+    # into the repo of the image
+    config = {
+      'architecture': 'amd64',
+      'os': 'linux',
+      'config': {},
+      'rootfs': {'type': 'layers', 'diff_ids': []},
+      'history': [],
+    }
+    p = image.parent
+    if not p:
+      return [], config
+    cli = self.client
+    manifest = cli.get_manifest(p.repo, p.tag)
+    p_config = json.loads(cli.get_blob(p.repo, manifest['config']['digest']))
+    for l in manifest['layers']:
+      self._mount(image.repo, l['digest'], p.repo)
+    config['rootfs']['diff_ids'] = list(p_config['rootfs']['diff_ids'])
+    config['history'] = list(p_config.get('history', []))
+    return list(manifest['layers']), config
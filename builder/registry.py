@@ -2,6 +2,18 @@ import os
 import docker
 import shutil
 import logging 
+import requests
+
+from urllib.parse import urljoin
+from concurrent import futures
+from typing import Dict, BinaryIO, Iterable, List, Union
+
+from base import DockerClient
+
+
+MANIFEST_V2_TYPE = 'application/vnd.docker.distribution.manifest.v2+json'
+MAX_CONNECTIONS = 32
+CATALOG_PAGE_SIZE = 1000
 
 
 class Registry:
@@ -22,7 +34,7 @@ class Registry:
 
   def purge(self):
     base_dir, contr_id = self.__base_dir, self.__contr_id
-    cli = docker.from_env()
+    cli = DockerClient.get()
     if not os.path.exists(base_dir):
       return 
     try:
@@ -38,4 +50,126 @@ class Registry:
   def __str__(self):
     return '%s:%d'%(self.address, self.port)
 
-  
\ No newline at end of file
+
+class RegistryClient:
+
+  # A client of the registry HTTP API V2 that uploads blobs and manifests
+  # directly, over a pooled HTTP session. The existence of the manifests, as
+  # well as the repositories and tags listed, is cached for the lifetime of 
+  # the client
+
+  def __init__(self, registry: str, max_conns: int=MAX_CONNECTIONS):
+    self.__registry = registry
+    self.__max_conns = max_conns
+    self.__session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max_conns)
+    self.__session.mount('http://', adapter)
+    self.__manifests = {}
+    self.__repos = None
+    self.__tags = {}
+
+  @property
+  def registry(self) -> str:
+    return self.__registry
+
+  def url(self, path: str) -> str:
+    return 'http://%s/v2/%s'%(self.registry, path)
+
+  def has_blob(self, repo: str, dgst: str) -> bool:
+    return self.__session.head(self.url('%s/blobs/%s'%(repo, dgst))).ok
+
+  def has_manifest(self, repo: str, ref: str) -> bool:
+    r = self.__session.head(self.url('%s/manifests/%s'%(repo, ref)), 
+                            headers={'Accept': MANIFEST_V2_TYPE})
+    return r.ok
+
+  def has_manifests(self, refs: Iterable[str], list_tags: bool=False) -> Dict[str, bool]:
+    # checks the existence of the manifests of `repo:tag` references 
+    # concurrently, either one by one or by listing the tags of their repos
+    refs = set(refs)
+    result = {r: self.__manifests[r] for r in refs if r in self.__manifests}
+    missing = [r for r in refs if r not in result]
+    if not missing:
+      return result
+    with futures.ThreadPoolExecutor(self.__max_conns) as workers:
+      if list_tags:
+        by_repo = {}
+        for r in missing:
+          repo, tag = r.split(':')
+          by_repo.setdefault(repo, []).append((r, tag))
+        if self.__repos is None:
+          self.__repos = set(self.list_repositories())
+        unlisted = [repo for repo in by_repo if repo not in self.__tags]
+        self.__tags.update(zip(unlisted, workers.map(lambda repo: set(self.list_tags(repo)) 
+                                                     if repo in self.__repos else set(), unlisted)))
+        checked = {r: tag in self.__tags[repo] for repo, refs in by_repo.items() for r, tag in refs}
+      else:
+        checked = dict(zip(missing, workers.map(lambda r: self.has_manifest(*r.split(':')), missing)))
+    self.__manifests.update(checked)
+    result.update(checked)
+    return result
+
+  def list_repositories(self) -> List[str]:
+    repos, url = [], self.url('_catalog?n=%d'%CATALOG_PAGE_SIZE)
+    while url:
+      r = self.__session.get(url)
+      r.raise_for_status()
+      repos += r.json().get('repositories') or []
+      url = r.links.get('next', {}).get('url')
+      url = url and urljoin(self.url(''), url)
+    return repos
+
+  def list_tags(self, repo: str) -> List[str]:
+    tags, url = [], self.url('%s/tags/list?n=%d'%(repo, CATALOG_PAGE_SIZE))
+    while url:
+      r = self.__session.get(url)
+      if r.status_code == 404:
+        return tags
+      r.raise_for_status()
+      tags += r.json().get('tags') or []
+      url = r.links.get('next', {}).get('url')
+      url = url and urljoin(self.url(''), url)
+    return tags
+
+  def get_blob(self, repo: str, dgst: str) -> bytes:
+    r = self.__session.get(self.url('%s/blobs/%s'%(repo, dgst)))
+    r.raise_for_status()
+    return r.content
+
+  def get_manifest(self, repo: str, ref: str) -> Dict[str, object]:
+    r = self.__session.get(self.url('%s/manifests/%s'%(repo, ref)), 
+                           headers={'Accept': MANIFEST_V2_TYPE})
+    r.raise_for_status()
+    return r.json()
+
+  def mount_blob(self, repo: str, dgst: str, mount_from: str) -> bool:
+    # mounts a blob from another repo unless it exists in the repo, and
+    # returns whether the blob is available in the repo
+    if self.has_blob(repo, dgst):
+      return True
+    r = self.__session.post(self.url('%s/blobs/uploads/'%repo), params={'mount': dgst, 'from': mount_from})
+    r.raise_for_status()
+    if r.status_code == 201:
+      return True
+    # the registry starts an upload instead if the blob cannot be mounted
+    self.__session.delete(urljoin(self.url(''), r.headers['Location']))
+    return False
+
+  def push_blob(self, repo: str, dgst: str, data: Union[bytes, BinaryIO], size: int) -> bool:
+    # uploads a blob unless it exists in the repo, and returns whether the 
+    # blob is uploaded
+    if self.has_blob(repo, dgst):
+      return False
+    r = self.__session.post(self.url('%s/blobs/uploads/'%repo))
+    r.raise_for_status()
+    loc = urljoin(self.url(''), r.headers['Location'])
+    r = self.__session.put(loc, params={'digest': dgst}, data=data, 
+                           headers={'Content-Type': 'application/octet-stream', 
+                                    'Content-Length': str(size)})
+    r.raise_for_status()
+    return True
+
+  def put_manifest(self, repo: str, ref: str, manifest: bytes, media_type: str=MANIFEST_V2_TYPE):
+    r = self.__session.put(self.url('%s/manifests/%s'%(repo, ref)), data=manifest, 
+                           headers={'Content-Type': media_type})
+    r.raise_for_status()
@@ -10,34 +10,91 @@ import logging
 import argparse
 
 from concurrent import futures
+from typing import Iterable
 from google.protobuf import empty_pb2
 
 import builder.builder_pb2 as pb2
 import builder.builder_pb2_grpc as builder_grpc
 
 from builder import Builder
+from builder.jobs import Job, JobQueue
+from builder.store import LayerStore
+from builder.stats import write_report
 from builder.registry import Registry
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# interval in seconds to check whether the watchers of jobs are gone
+WATCH_HEARTBEAT = 5.
+
 
 class ImageBuilderServicer(builder_grpc.ImageBuilderServicer):
 
-  def __init__(self, registry: Registry, args: argparse.Namespace):
+  def __init__(self, registry: Registry, args: argparse.Namespace, store: LayerStore=None):
     self.__registry = registry
     self.__args = args
+    self.__store = store
+    self.__jobs = JobQueue(self._run, args.max_jobs)
 
   def Build(self, bs: pb2.ImageBuildSet, context) -> pb2.ImageBuildSummary:
-    args = self.__args
-    builder = Builder(str(self.__registry), args.scaling_factor, args.build_dir)
-    total_size = builder.build(bs)
-    return pb2.ImageBuildSummary(total_size=total_size)
+    return self._wait(self.__jobs.submit(bs), context)
+
+  def BuildStream(self, bss: Iterable[pb2.ImageBuildSet], context) -> pb2.ImageBuildSummary:
+    # the stream is consumed by the job as the images arrive
+    job = self.__jobs.submit(bss)
+    context.send_initial_metadata((('job-id', job.id), ))
+    return self._wait(job, context)
+
+  def Submit(self, bs: pb2.ImageBuildSet, context) -> pb2.BuildJob:
+    return pb2.BuildJob(id=self.__jobs.submit(bs).id)
+
+  def Watch(self, job: pb2.BuildJob, context):
+    j = self.__jobs.get(job.id)
+    if j is None:
+      context.abort(grpc.StatusCode.NOT_FOUND, 'Job %s is not found'%job.id)
+    for e in j.watch(WATCH_HEARTBEAT):
+      if e is None:
+        if not context.is_active():
+          return
+        continue
+      yield e
+
+  def Cancel(self, job: pb2.BuildJob, context) -> empty_pb2.Empty:
+    j = self.__jobs.get(job.id)
+    if j is None:
+      context.abort(grpc.StatusCode.NOT_FOUND, 'Job %s is not found'%job.id)
+    j.cancel()
+    return empty_pb2.Empty()
 
   def Purge(self, empty: empty_pb2.Empty, context) -> empty_pb2.Empty:
     self.__registry.purge()
     return empty
 
+  def _wait(self, job: Job, context) -> pb2.ImageBuildSummary:
+    # the job is cancelled once the call is terminated, e.g., cancelled or 
+    # timed out, which does nothing if the job is done already
+    if not context.add_callback(job.cancel):
+      job.cancel()
+    for e in job.watch():
+      if e.kind == pb2.BuildEvent.FAILED:
+        context.abort(grpc.StatusCode.INTERNAL, e.error)
+      if e.kind == pb2.BuildEvent.FINISHED:
+        return e.summary
+
+  def _run(self, job: Job) -> pb2.ImageBuildSummary:
+    args = self.__args
+    builder = Builder(str(self.__registry), args.scaling_factor, args.build_dir, 
+                      args.block_pool_size * 2 ** 20, args.backend, args.list_registry, self.__store, 
+                      args.disk_budget * 2 ** 20, job.publish, job.cancelled)
+    if job.streamed:
+      summary = builder.build_stream(job.build_set)
+    else:
+      summary = builder.build(job.build_set)
+    if args.report_dir:
+      write_report('%s/%s.json'%(args.report_dir, job.id), job.id, summary)
+    return summary
+
 
 def parse_args() -> argparse.Namespace:
   parser = argparse.ArgumentParser(description='Docker image builder GRPC service')
@@ -49,6 +106,29 @@ def parse_args() -> argparse.Namespace:
                       help='Build directory')
   parser.add_argument('--scaling-factor', type=float, default=2., dest='scaling_factor', 
                       help='Scaling factor of parallel build')
+  parser.add_argument('--layer-store-size', type=int, default=0, dest='layer_store_size', 
+                      help='Disk budget (in MB) of the layer store kept in the build directory across '
+                           'builds. Layers are built from scratch for every build if not set')
+  parser.add_argument('--disk-budget', type=int, default=0, dest='disk_budget', 
+                      help='Disk budget (in MB) of the layers in a build. If set, the layers are generated '
+                           'along with the images needing them and removed once these images are pushed, '
+                           'instead of all being generated up front')
+  parser.add_argument('--block-pool-size', type=int, default=0, dest='block_pool_size', 
+                      help='Size (in MB) of the pool of random blocks from which the layers are '
+                           'assembled. Layers are fully randomly generated if not set')
+  parser.add_argument('--backend', type=str, default='docker', choices=['docker', 'oci'], dest='backend', 
+                      help='Build and push the images via the Docker daemon, or assemble and push '
+                           'them directly to the registry')
+  parser.add_argument('--list-registry', action='store_true', dest='list_registry', 
+                      help='Check the existing images by listing the repositories and tags of the '
+                           'registry instead of checking the images one by one')
+  parser.add_argument('--max-jobs', type=int, default=1, dest='max_jobs', 
+                      help='Maximum number of build jobs running concurrently, while the others are queued')
+  parser.add_argument('--max-rpc-workers', type=int, default=10, dest='max_rpc_workers', 
+                      help='Maximum number of RPCs served concurrently')
+  parser.add_argument('--report-dir', type=str, default=None, dest='report_dir', 
+                      help='Directory of the JSON reports of the time spent and the bytes processed in '
+                           'the phases of the build jobs, named after the job IDs')
   parser.add_argument('--registry-dir', type=str, required=True, dest='reg_dir', 
                       help='Docker registry data directory')
   parser.add_argument('--registry-port', type=int, default=5000, dest='reg_port', 
@@ -60,9 +140,14 @@ def parse_args() -> argparse.Namespace:
 
 def serve(args: argparse.Namespace):
   registry = Registry(args.host, args.reg_port, args.reg_dir, args.reg_contr_id)
-  server = grpc.server(futures.ThreadPoolExecutor(max_workers=1))
+  store = None
+  if args.report_dir:
+    os.makedirs(args.report_dir, exist_ok=True)
+  if args.layer_store_size > 0:
+    store = LayerStore('%s/store'%args.build_dir, args.layer_store_size * 2 ** 20)
+  server = grpc.server(futures.ThreadPoolExecutor(max_workers=args.max_rpc_workers))
   builder_grpc.add_ImageBuilderServicer_to_server(
-    ImageBuilderServicer(registry, args), server)
+    ImageBuilderServicer(registry, args, store), server)
   server.add_insecure_port('[::]:%d'%args.port)
   server.start()
   logging.info('Image builder service is listening at %d ...'%args.port)
@@ -0,0 +1,152 @@
+import os
+import json
+import time
+import logging
+import threading
+
+from bisect import bisect_left
+from typing import Iterable, List, Tuple
+
+import util
+import builder.builder_pb2 as pb2
+
+
+# upper bounds in seconds of the buckets of the phase histograms, beyond
+# which durations fall in the last bucket
+HISTOGRAM_BOUNDS = (.001, .01, .1, 1., 10., 60., 600.)
+
+
+class PhaseTimer:
+
+  # Records the time spent and the bytes processed in the phases of the build
+  # run by a worker, as samples sent back to the builder along with the result
+
+  def __init__(self):
+    self.__samples = []
+
+  @property
+  def samples(self) -> List[Tuple[str, float, int]]:
+    return self.__samples
+
+  def start(self) -> float:
+    return time.time()
+
+  def stop(self, phase: str, start: float, n_bytes: int=0):
+    self.__samples += (phase, time.time() - start, n_bytes),
+
+
+class BuildStats:
+
+  # Aggregates the samples of the phases of a build into counters and
+  # histograms of durations, in the order the phases are first seen. The
+  # samples are recorded from both the builder and the feeder threads
+
+  def __init__(self):
+    self.__lock = threading.Lock()
+    self.__start = time.time()
+    self.__phases = {}
+    self.__images_built = self.__images_failed = 0
+    self.__api_calls, self.__api_seconds = 0, 0.
+
+  @property
+  def duration(self) -> float:
+    return time.time() - self.__start
+
+  def add(self, samples: List[Tuple[str, float, int]]):
+    with self.__lock:
+      for phase, seconds, n_bytes in samples:
+        self._record(phase, seconds, n_bytes)
+
+  def record(self, phase: str, seconds: float, n_bytes: int=0):
+    with self.__lock:
+      self._record(phase, seconds, n_bytes)
+
+  def image_done(self, ok: bool):
+    with self.__lock:
+      if ok:
+        self.__images_built += 1
+      else:
+        self.__images_failed += 1
+
+  def add_api_calls(self, n_calls: int, latency: float):
+    # the Docker API calls are counted by every worker and the builder itself
+    with self.__lock:
+      self.__api_calls += n_calls
+      self.__api_seconds += latency
+
+  def summary(self, total_size: int) -> pb2.ImageBuildSummary:
+    with self.__lock:
+      return pb2.ImageBuildSummary(total_size=total_size, duration=self.duration,
+                                   images_built=self.__images_built, images_failed=self.__images_failed,
+                                   docker_api_calls=self.__api_calls, docker_api_seconds=self.__api_seconds,
+                                   bucket_bounds=HISTOGRAM_BOUNDS, phases=self.__phases.values())
+
+  def _record(self, phase: str, seconds: float, n_bytes: int):
+    p = self.__phases.get(phase)
+    if p is None:
+      p = self.__phases[phase] = pb2.PhaseSummary(name=phase, histogram=[0] * (len(HISTOGRAM_BOUNDS) + 1))
+    p.count += 1
+    p.total_seconds += seconds
+    p.max_seconds = max(p.max_seconds, seconds)
+    p.bytes += int(n_bytes)
+    p.histogram[bisect_left(HISTOGRAM_BOUNDS, seconds)] += 1
+
+
+def merge_summaries(summaries: Iterable[pb2.ImageBuildSummary], duration: float) -> pb2.ImageBuildSummary:
+  # merges the summaries of builds run in parallel over the given wall-clock time
+  merged, phases = pb2.ImageBuildSummary(duration=duration, bucket_bounds=HISTOGRAM_BOUNDS), {}
+  for s in summaries:
+    merged.total_size += s.total_size
+    merged.images_built += s.images_built
+    merged.images_failed += s.images_failed
+    merged.docker_api_calls += s.docker_api_calls
+    merged.docker_api_seconds += s.docker_api_seconds
+    for p in s.phases:
+      m = phases.get(p.name)
+      if m is None:
+        m = phases[p.name] = pb2.PhaseSummary(name=p.name, histogram=[0] * (len(HISTOGRAM_BOUNDS) + 1))
+      m.count += p.count
+      m.total_seconds += p.total_seconds
+      m.max_seconds = max(m.max_seconds, p.max_seconds)
+      m.bytes += p.bytes
+      for i, n in enumerate(p.histogram):
+        m.histogram[i] += n
+  merged.phases.extend(phases.values())
+  return merged
+
+
+def log_summary(summary: pb2.ImageBuildSummary):
+  logging.info('Built %d images, failed: %d, total size: %s, duration: %.3fs'%(summary.images_built,
+               summary.images_failed, util.size(summary.total_size), summary.duration))
+  logging.info('Docker API calls: %d, total latency: %.3fs'%(summary.docker_api_calls, summary.docker_api_seconds))
+  for p in summary.phases:
+    throughput = ', %s/s'%util.size(p.bytes/p.total_seconds) if p.bytes and p.total_seconds > 0 else ''
+    logging.info('Phase %s: count: %d, total: %.3fs, mean: %.3fs, max: %.3fs, bytes: %s%s'%(p.name, p.count,
+                 p.total_seconds, p.total_seconds/max(p.count, 1), p.max_seconds, util.size(p.bytes), throughput))
+
+
+def write_report(path: str, job_id: str, summary: pb2.ImageBuildSummary):
+  # the report is a JSON object of the summary fields, with the histograms
+  # keyed by the upper bounds of their buckets
+  bounds = ['%g'%b for b in summary.bucket_bounds] + ['inf']
+  report = {
+    'job_id': job_id,
+    'finished_at': time.time(),
+    'total_size': summary.total_size,
+    'duration': summary.duration,
+    'images_built': summary.images_built,
+    'images_failed': summary.images_failed,
+    'docker_api_calls': summary.docker_api_calls,
+    'docker_api_seconds': summary.docker_api_seconds,
+    'phases': {p.name: {
+      'count': p.count,
+      'total_seconds': p.total_seconds,
+      'max_seconds': p.max_seconds,
+      'bytes': p.bytes,
+      'histogram': dict(zip(bounds, p.histogram)),
+    } for p in summary.phases},
+  }
+  tmp_f = '%s.tmp'%path
+  with open(tmp_f, 'w') as f:
+    json.dump(report, f, indent=2)
+  os.replace(tmp_f, path)
@@ -0,0 +1,126 @@
+import os
+import logging
+import threading
+
+from collections import OrderedDict
+from typing import Iterable
+
+import util
+
+
+class LayerStore:
+
+  # A persistent store of the layers, and of their blobs for the OCI backend,
+  # addressed by the layer digests and shared by the builds. The layers in use
+  # by in-flight builds are reference counted, and the least recently used
+  # layers are evicted once the disk usage exceeds the capacity. Layers are
+  # written to temporary files and renamed into place, so the leftovers of a
+  # crash are removed when the store is opened
+
+  def __init__(self, path: str, capacity: int):
+    self.__path = path
+    self.__capacity = capacity
+    self.__lock = threading.Lock()
+    self.__refs = {}
+    self.__entries = OrderedDict()
+    self.__usage = 0
+    for d in ('layer', 'blob'):
+      os.makedirs('%s/%s'%(path, d), exist_ok=True)
+    self._scan()
+
+  @property
+  def path(self) -> str:
+    return self.__path
+
+  @property
+  def capacity(self) -> int:
+    return self.__capacity
+
+  @property
+  def usage(self) -> int:
+    return self.__usage
+
+  def acquire(self, digests: Iterable[str]):
+    with self.__lock:
+      for d in digests:
+        self.__refs[d] = self.__refs.get(d, 0) + 1
+        if d in self.__entries:
+          self.__entries.move_to_end(d)
+          self._touch(d)
+
+  def add(self, digests: Iterable[str]):
+    # records the layers materialized in the store
+    with self.__lock:
+      for d in digests:
+        if not os.path.exists('%s/layer/%s'%(self.path, d)):
+          # the layer is freed by the build
+          self.__usage -= self.__entries.pop(d, 0)
+          continue
+        usage = self._usage(d)
+        self.__usage += usage - self.__entries.pop(d, 0)
+        self.__entries[d] = usage
+
+  def release(self, digests: Iterable[str]):
+    with self.__lock:
+      for d in digests:
+        n_refs = self.__refs.get(d, 0) - 1
+        if n_refs > 0:
+          self.__refs[d] = n_refs
+        else:
+          self.__refs.pop(d, None)
+      self._evict()
+
+  def _evict(self):
+    n_evicted, freed = 0, 0
+    for d in list(self.__entries):
+      if self.__usage <= self.__capacity:
+        break
+      if d in self.__refs:
+        continue
+      size = self.__entries.pop(d)
+      for f in self._files(d):
+        if os.path.exists(f):
+          os.remove(f)
+      self.__usage -= size
+      n_evicted, freed = n_evicted + 1, freed + size
+    if n_evicted > 0:
+      logging.info('Evicted %d layers from %s, freed: %s, usage: %s/%s'%(n_evicted, self.path, util.size(freed),
+                   util.size(self.__usage), util.size(self.__capacity)))
+
+  def _scan(self):
+    entries = []
+    for d in ('layer', 'blob'):
+      base = '%s/%s'%(self.path, d)
+      for f in os.listdir(base):
+        if f.endswith('.tmp'):
+          os.remove('%s/%s'%(base, f))
+    # the temporary files of the block pool filled in the store
+    for f in os.listdir(self.path):
+      if f.startswith('pool.') and f.endswith('.tmp'):
+        os.remove('%s/%s'%(self.path, f))
+    base = '%s/layer'%self.path
+    for f in os.listdir(base):
+      entries += (os.stat('%s/%s'%(base, f)).st_mtime, f),
+    for _, d in sorted(entries):
+      self.__entries[d] = self._usage(d)
+      self.__usage += self.__entries[d]
+    logging.info('Found %d layers in %s, usage: %s/%s'%(len(self.__entries), self.path,
+                 util.size(self.__usage), util.size(self.__capacity)))
+
+  def _files(self, dgst: str) -> Iterable[str]:
+    return ('%s/layer/%s'%(self.path, dgst), '%s/blob/%s'%(self.path, dgst), '%s/blob/%s.json'%(self.path, dgst))
+
+  def _usage(self, dgst: str) -> int:
+    # the layers are sparse, hence the allocated blocks are counted
+    usage = 0
+    for f in self._files(dgst):
+      if os.path.exists(f):
+        usage += os.stat(f).st_blocks * 512
+    return usage
+
+  def _touch(self, dgst: str):
+    # the access times survive restarts as modification times of the layers
+    try:
+      os.utime('%s/layer/%s'%(self.path, dgst))
+    except FileNotFoundError:
+      pass
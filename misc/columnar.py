@@ -0,0 +1,169 @@
+from __future__ import annotations
+
+import os
+import sys
+
+proj_path = '/'.join(os.path.abspath(os.path.dirname(__file__)).split('/')[:-1])
+sys.path += proj_path,
+
+import shutil
+import numpy as np
+
+from typing import Generator, Iterable, Tuple
+
+import util
+
+from util import URI_KINDS
+
+
+# A columnar trace is a directory of .npy files that can be memory-mapped:
+#   events.npy          events sorted by client and timestamp
+#   clients.npy         the range of events of every client
+#   uris.npy            unique URIs along with their parsed repo, kind and ref
+#   strings.npy         UTF-8 bytes of the interned strings
+#   string_offsets.npy  offsets of the interned strings in strings.npy
+# Strings are referred to by their IDs in the string table and timestamps are
+# in epoch nanoseconds.
+EVENT_DTYPE = np.dtype([('client', '<i4'), ('timestamp', '<i8'), ('host', '<i4'),
+                        ('uri', '<i4'), ('status', '<i2'), ('size', '<i8')])
+CLIENT_DTYPE = np.dtype([('name', '<i4'), ('start', '<i8'), ('end', '<i8')])
+URI_DTYPE = np.dtype([('uri', '<i4'), ('repo', '<i4'), ('kind', '<i1'), ('ref', '<i4')])
+
+WRITE_CHUNK_SIZE = 2 ** 16
+
+
+def trace_path(prefix: str, data_center: str) -> str:
+  return '%s/%s.trace'%(prefix, data_center)
+
+
+class TraceWriter:
+
+  # Events are appended to a raw file in the trace directory as they are
+  # added, and copied into events.npy by chunks once their number is known,
+  # so that the event table is never held in memory. A writer based on an
+  # existing trace starts with its string and URI tables, so that the events
+  # of the trace can be copied as they are
+
+  def __init__(self, path: str, base: Trace=None):
+    self.__path = path
+    self.__strings = {}
+    self.__uris, self.__uri_rows = {}, []
+    self.__clients = []
+    self.__n_events = 0
+    if base is not None:
+      strings = list(base.strings())
+      self.__strings = {s: i for i, s in enumerate(strings)}
+      self.__uri_rows = base.uris.tolist()
+      self.__uris = {strings[r[0]]: i for i, r in enumerate(self.__uri_rows)}
+    if os.path.exists(path):
+      shutil.rmtree(path)
+    os.makedirs(path)
+    self.__events_f = open('%s/events.raw'%path, 'wb')
+
+  def intern(self, s: str) -> int:
+    return self.__strings.setdefault(s, len(self.__strings))
+
+  def add_client(self, cli: str, events: Iterable[dict]):
+    cli_id, start, rows = self.intern(cli), self.__n_events, []
+    for e in events:
+      rows += (cli_id, e['timestamp'], self.intern(e['host']), self._uri(e['uri']), e['status'], e['size']),
+      if len(rows) >= WRITE_CHUNK_SIZE:
+        self._flush(rows)
+        rows = []
+    self._flush(rows)
+    self.__clients += (cli_id, start, self.__n_events),
+
+  def copy_client(self, cli: str, events: np.ndarray):
+    # copies the events of a client of the base trace
+    start = self.__n_events
+    for i in range(0, len(events), WRITE_CHUNK_SIZE):
+      self.__events_f.write(np.ascontiguousarray(events[i:i + WRITE_CHUNK_SIZE]).tobytes())
+    self.__n_events += len(events)
+    self.__clients += (self.intern(cli), start, self.__n_events),
+
+  def save(self):
+    path, raw_path = self.__path, '%s/events.raw'%self.__path
+    self.__events_f.close()
+    events = np.lib.format.open_memmap('%s/events.npy'%path, mode='w+', dtype=EVENT_DTYPE, shape=(self.__n_events, ))
+    if self.__n_events > 0:
+      raw = np.memmap(raw_path, dtype=EVENT_DTYPE, mode='r', shape=(self.__n_events, ))
+      for i in range(0, self.__n_events, WRITE_CHUNK_SIZE):
+        events[i:i + WRITE_CHUNK_SIZE] = raw[i:i + WRITE_CHUNK_SIZE]
+      del raw
+    events.flush()
+    del events
+    os.remove(raw_path)
+    np.save('%s/clients.npy'%path, np.array(self.__clients, dtype=CLIENT_DTYPE))
+    np.save('%s/uris.npy'%path, np.array(self.__uri_rows, dtype=URI_DTYPE))
+    encoded = [s.encode('utf-8') for s in self.__strings]
+    offsets = np.zeros(len(encoded) + 1, dtype='<i8')
+    np.cumsum([len(s) for s in encoded], out=offsets[1:])
+    np.save('%s/strings.npy'%path, np.frombuffer(b''.join(encoded), dtype=np.uint8))
+    np.save('%s/string_offsets.npy'%path, offsets)
+
+  def _uri(self, uri: str) -> int:
+    uri_id = self.__uris.get(uri)
+    if uri_id is None:
+      repo, kind, ref = util.parse_uri(uri)
+      if repo is None or kind not in URI_KINDS:
+        row = (self.intern(uri), -1, -1, -1)
+      else:
+        row = (self.intern(uri), self.intern(repo), URI_KINDS.index(kind), self.intern(ref))
+      uri_id = self.__uris[uri] = len(self.__uri_rows)
+      self.__uri_rows += row,
+    return uri_id
+
+  def _flush(self, rows):
+    if rows:
+      self.__events_f.write(np.array(rows, dtype=EVENT_DTYPE).tobytes())
+      self.__n_events += len(rows)
+
+
+class Trace:
+
+  def __init__(self, path: str, mmap_mode: str='r'):
+    self.__events = np.load('%s/events.npy'%path, mmap_mode=mmap_mode)
+    self.__clients = np.load('%s/clients.npy'%path, mmap_mode=mmap_mode)
+    self.__uris = np.load('%s/uris.npy'%path, mmap_mode=mmap_mode)
+    self.__strings = np.load('%s/strings.npy'%path, mmap_mode=mmap_mode)
+    self.__offsets = np.load('%s/string_offsets.npy'%path, mmap_mode=mmap_mode)
+    self.__cache = {}
+
+  @property
+  def events(self) -> np.ndarray:
+    return self.__events
+
+  @property
+  def uris(self) -> np.ndarray:
+    return self.__uris
+
+  def strings(self) -> Generator[str, None, None]:
+    buf, offsets = self.__strings.tobytes(), self.__offsets.tolist()
+    for start, end in zip(offsets, offsets[1:]):
+      yield buf[start:end].decode('utf-8')
+
+  def string(self, i: int) -> str:
+    s = self.__cache.get(i)
+    if s is None:
+      start, end = self.__offsets[i], self.__offsets[i + 1]
+      s = self.__cache[i] = self.__strings[start:end].tobytes().decode('utf-8')
+    return s
+
+  def clients(self) -> Generator[Tuple[str, np.ndarray], None, None]:
+    for name, start, end in self.__clients.tolist():
+      yield self.string(name), self.__events[start:end]
+
+  def records(self) -> Generator[Tuple[str, Generator[dict, None, None]], None, None]:
+    # yields the events of every client decoded as the sanitizer's records
+    for name, events in self.clients():
+      yield name, self.decode(events)
+
+  def decode(self, events: np.ndarray) -> Generator[dict, None, None]:
+    uris = self.__uris['uri']
+    for i in range(0, len(events), WRITE_CHUNK_SIZE):
+      chunk = events[i:i + WRITE_CHUNK_SIZE]
+      for (_, ts, host, _, status, size), uri in zip(chunk.tolist(), uris[chunk['uri']].tolist()):
+        yield {'timestamp': ts, 'host': self.string(host), 'uri': self.string(uri), 'status': status, 'size': size}
+
+  def __len__(self) -> int:
+    return len(self.__events)
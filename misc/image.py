@@ -5,14 +5,16 @@ proj_path = '/'.join(os.path.abspath(os.path.dirname(__file__)).split('/')[:-1])
 sys.path += proj_path,
 
 import json 
+import mmap
 import numpy as np
 
-from collections import defaultdict
+from collections.abc import Mapping
 
 import util
 import builder.builder_pb2 as pb2
 
-from base import Image
+from base import Image, ImageIndex
+from misc.columnar import Trace, trace_path
 
 
 DATA_CENTER = 'syd01'
@@ -23,13 +25,15 @@ MIN_DIFF = 100
 
 
 def parse_images(data_center, prefix='../data/clean_data', min_throughput=100, min_diff=100):
-  images = {}
+  if os.path.isdir(trace_path(prefix, data_center)):
+    return parse_trace_images(Trace(trace_path(prefix, data_center)))
+  images, uri_parser = {}, util.URIParser()
   data_dir = '%s/%s'%(prefix, data_center)
   for c in os.listdir(data_dir):
     with open('%s/%s'%(data_dir, c)) as f:
       cur_pulls = {}
-      for i, e in enumerate(json.load(f)):
-        repo, etype, tag = util.parse_uri(e['uri'])
+      events = json.load(f)
+      for e, (repo, etype, tag) in zip(events, uri_parser.parse_many([e['uri'] for e in events])):
         if repo is None:
           continue
         if etype == 'manifests':
@@ -45,8 +49,127 @@ def parse_images(data_center, prefix='../data/clean_data', min_throughput=100, m
   return {img_id: img for img_id, img in images.items() if len(img.layers) > 0}
 
 
+def parse_trace_images(trace):
+  images = {}
+  uris = trace.uris
+  repos, kinds, refs = uris['repo'].tolist(), uris['kind'].tolist(), uris['ref'].tolist()
+  manifests = util.URI_KINDS.index('manifests')
+  for _, events in trace.clients():
+    cur_pulls = {}
+    for uri, size in zip(events['uri'].tolist(), events['size'].tolist()):
+      repo = repos[uri]
+      if repo < 0:
+        continue
+      if kinds[uri] == manifests:
+        img = Image(trace.string(repo), trace.string(refs[uri]))
+        img = images.setdefault(str(img), img)
+        cur_pulls[repo] = img
+      else:
+        img = cur_pulls.get(repo)
+        if img is None:
+          continue
+        img.add_layer(trace.string(refs[uri]), size)
+  return {img_id: img for img_id, img in images.items() if len(img.layers) > 0}
+
+
+SNAPSHOT_FILE = 'images.snapshot'
+SNAPSHOT_VERSION = 1
+
+
+# Read-only mapping of image IDs to pb2.Image backed by a snapshot, whose body
+# is a serialized pb2.ImageBuildSet. Images are only decoded from the snapshot
+# when they are looked up.
+class ImageCatalog(Mapping):
+
+  def __init__(self, ids, offsets, body):
+    self.__index = {img_id: i for i, img_id in enumerate(ids)}
+    self.__offsets = offsets
+    self.__body = body
+    self.__images = {}
+
+  def raw(self, img_id) -> bytes:
+    # the encoded field of the image in a pb2.ImageBuildSet
+    i = self.__index[img_id]
+    return self.__body[self.__offsets[i]:self.__offsets[i + 1]]
+
+  def build_set(self, img_ids) -> pb2.ImageBuildSet:
+    return pb2.ImageBuildSet.FromString(b''.join(self.raw(i) for i in img_ids))
+
+  def __getitem__(self, img_id) -> pb2.Image:
+    img = self.__images.get(img_id)
+    if img is None:
+      img = self.__images[img_id] = self.build_set([img_id]).images[0]
+    return img
+
+  def __iter__(self):
+    return iter(self.__index)
+
+  def __len__(self) -> int:
+    return len(self.__index)
+
+
+def _encode_varint(n):
+  buf = bytearray()
+  while n > 0x7f:
+    buf.append((n & 0x7f) | 0x80)
+    n >>= 7
+  buf.append(n)
+  return bytes(buf)
+
+
+def _snapshot_sources(data_dir):
+  sources = {}
+  for fn in ('layers.json', 'images.json'):
+    st = os.stat('%s/%s'%(data_dir, fn))
+    sources[fn] = [st.st_mtime, st.st_size]
+  return sources
+
+
+def _load_snapshot(data_dir, sources):
+  path = '%s/%s'%(data_dir, SNAPSHOT_FILE)
+  if not os.path.exists(path):
+    return None
+  with open(path, 'rb') as f:
+    header = json.loads(f.readline())
+    if header.get('version') != SNAPSHOT_VERSION or header.get('sources') != sources:
+      return None
+    start = f.tell()
+    body = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+  return ImageCatalog(header['ids'], [start + off for off in header['offsets']], body)
+
+
+def _encode_snapshot(images):
+  # the body is a valid serialized pb2.ImageBuildSet, in which every image is
+  # a length-delimited field 1
+  ids, offsets, chunks = [], [0], []
+  for img_id, img in images.items():
+    data = img.SerializeToString()
+    chunks += b'\x0a' + _encode_varint(len(data)) + data,
+    ids += img_id,
+    offsets += offsets[-1] + len(chunks[-1]),
+  return ids, offsets, b''.join(chunks)
+
+
+def _save_snapshot(data_dir, sources, ids, offsets, body):
+  header = {'version': SNAPSHOT_VERSION, 'sources': sources, 'ids': ids, 'offsets': offsets}
+  path = '%s/%s'%(data_dir, SNAPSHOT_FILE)
+  tmp_path = '%s.%d.tmp'%(path, os.getpid())
+  try:
+    with open(tmp_path, 'wb') as f:
+      f.write(json.dumps(header).encode('utf-8'))
+      f.write(b'\n')
+      f.write(body)
+    os.replace(tmp_path, path)
+  except OSError:
+    print('Failed to save the image snapshot in %s'%data_dir)
+
+
 def load_images(data_center, prefix='../data/images'):
   data_dir = '%s/%s'%(prefix, data_center)
+  sources = _snapshot_sources(data_dir)
+  catalog = _load_snapshot(data_dir, sources)
+  if catalog is not None:
+    return catalog
   with open('%s/layers.json'%data_dir) as f:
     layers = {l['digest']: l for l in json.load(f)}
   with open('%s/images.json'%data_dir) as f:
@@ -57,7 +180,10 @@ def load_images(data_center, prefix='../data/images'):
                       layers=[pb2.Layer(digest=dgst, size=layers[dgst]['size']) 
                               for dgst in i['layers']])
       images[Image.ID(img.repo, img.tag)] = img
-  return images
+  # the images are returned as a catalog on both the cold and warm loads
+  ids, offsets, body = _encode_snapshot(images)
+  _save_snapshot(data_dir, sources, ids, offsets, body)
+  return ImageCatalog(ids, offsets, body)
 
 
 def save_images(images, data_center, dest='../data/images'):
@@ -65,8 +191,7 @@ def save_images(images, data_center, dest='../data/images'):
   data_dir = '%s/%s'%(dest, data_center)
   os.makedirs(data_dir, exist_ok=True)
   images = list(images.values())
-  for i in images:
-    i.squash_layers()
+  Image.squash_images(images)
   layers = set(l for i in images for l in i.layers)
   with open('%s/images.json'%data_dir, 'w') as f:
     json.dump([i.to_json() for i in images], f, indent=2)
@@ -74,34 +199,55 @@ def save_images(images, data_center, dest='../data/images'):
     json.dump([l.to_json() for l in layers], f, indent=2)
 
 
+def group_aliases(images):
+  # buckets images by the fingerprints of their layer sets. The first image of
+  # a bucket is elected as the primary, which is the image Builder builds while
+  # tagging the others. Every image gets the rest of its bucket as aliases
+  index = ImageIndex(images.values())
+  groups = index.groups
+  alias_count = 0
+  for members in groups.values():
+    if len(members) == 1:
+      continue
+    primary = members[0]
+    print('%s == %s, # of layers: %d'%(primary, ' == '.join(str(a) for a in members[1:]), len(primary.layers)))
+    for img in members:
+      for a in members:
+        if a is not img:
+          img.add_alias(a)
+    alias_count += len(members) - 1
+  print('Find %d aliases of %d primary images'%(alias_count, sum(1 for m in groups.values() if len(m) > 1)))
+  return index
+
+
 def resolve_image_dependencies(images):
-  layer_map = defaultdict(list)
-  for img in images.values():
-    for l in img.layers:
-      layer_map[l.digest] += img, 
-  dep_count, alias_count = 0, 0
-  for img in images.values():
-    for l in img.layers:
-      for p in layer_map[l.digest]:
-        if p == img:
-          continue
-        if img.is_child(p):
-          print('%s -> %s, parent: %d, child: %d'%(p, img, len(p.layers), len(img.layers)))
-          img.parent = p
-          dep_count += 1
-        elif img.has_alias(p):
-          print('%s == %s, # of layers: %d'%(p, img, len(p.layers)))
-          img.add_alias(p)
-          alias_count += 1
+  index = group_aliases(images)
+  groups = index.groups
+  order = {str(img): i for i, img in enumerate(images.values())}
+  dep_count = 0
+  for fp, members in groups.items():
+    s = index.layer_set(fp)
+    candidates = index.subsets(s)
+    for img in members:
+      pos = {l.digest: j for j, l in enumerate(img.layers)}
+      parent, parent_key = None, None
+      for p_fp in candidates:
+        p = index.layer_set(p_fp)
+        # the closest parent has the most layers. Ties are broken by the
+        # earliest shared layer and then the order of the images
+        key = (-len(p), min(pos[x] for x in p), order[str(groups[p_fp][0])])
+        if parent_key is None or key < parent_key:
+          parent, parent_key = groups[p_fp][0], key
+      if parent is not None:
+        img.parent = parent
+        print('%s -> %s, parent: %d, child: %d'%(parent, img, len(parent.layers), len(s)))
+        dep_count += 1
   print('Find %d dependencies among %d images'%(dep_count, len(images)))
-  print('Find %d aliases'%(alias_count/2))
   return images
 
 if __name__ == '__main__':
   images = parse_images(DATA_CENTER)
   resolve_image_dependencies(images)
-  for i in images.values():
-    i.squash_layers()
   save_images(images, DATA_CENTER)
   total_size = sum(l.size for i in images.values() for l in i.layers)
   print('Total size: %s'%util.size(total_size))
\ No newline at end of file
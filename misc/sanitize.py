@@ -1,61 +1,563 @@
 import os
+import sys
+
+proj_path = '/'.join(os.path.abspath(os.path.dirname(__file__)).split('/')[:-1])
+sys.path += proj_path,
+
+import re
 import time
-import json 
+import json
+import math
+import heapq
 import shutil
 import argparse
 import datetime
+import tempfile
+import functools
+import multiprocessing as mp
 
+from typing import Dict, Generator, Iterable, List, Tuple
 from dateutil import parser
 
+import misc.columnar as columnar
+
+
+READ_CHUNK_SIZE = 2 ** 20 # 1MB
+DECODE_BATCH_SIZE = 4096
+
+# fixed-format ISO-8601 timestamps, e.g., 2017-06-20T02:44:48.123456789Z
+TIMESTAMP_RE = re.compile(r'(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}):(\d{2})(?:\.(\d+))?(Z|[+-]\d{2}:?\d{2})\Z')
+NS_PER_SEC = 10 ** 9
 
 
 def parse_args():
   parser = argparse.ArgumentParser(description='Sanitize the Docker registry dataset and group them by users')
-  parser.add_argument('-i', '--input', type=str, dest='input', default='../../data/data_centers', 
+  parser.add_argument('-i', '--input', type=str, dest='input', default='../../data/data_centers',
                       help='Base directory of the input datasets')
-  parser.add_argument('-o', '--output', type=str, dest='output', default='../../data/clean_data', 
+  parser.add_argument('-o', '--output', type=str, dest='output', default='../../data/clean_data',
                       help='Base directory of the output datasets')
   parser.add_argument('-d', '--data-center', type=str, dest='data_center', default='dev-mon01',
                       help='Data center of the dataset')
+  parser.add_argument('-s', '--streaming', action='store_true', dest='streaming',
+                      help='Parse the input incrementally and spill sorted runs to disk')
+  parser.add_argument('-m', '--memory-budget', type=int, dest='mem_budget', default=1024,
+                      help='Approximate memory budget (in MB) of the buffered events in streaming mode')
+  parser.add_argument('--spill-dir', type=str, dest='spill_dir', default=None,
+                      help='Directory where the sorted runs are spilled in streaming mode')
+  parser.add_argument('-w', '--workers', type=int, dest='workers', default=1,
+                      help='Number of worker processes sorting the input files in parallel')
+  parser.add_argument('-f', '--format', type=str, dest='format', default='json', choices=['json', 'columnar'],
+                      help='Output format: a JSON file per client, or a memory-mappable columnar trace per data center')
+  parser.add_argument('--incremental', action='store_true', dest='incremental',
+                      help='Only fold the input files not yet recorded in the manifest into the existing output')
+  parser.add_argument('--batch-size', type=int, dest='batch_size', default=16,
+                      help='Number of input files folded into the output per committed batch in incremental mode')
   return parser.parse_args()
 
 
-def select_and_group(args):
-  in_dir, out_dir, data_center = args.input, args.output, args.data_center
-  events = {} 
-  start_time = time.time()
-  for fn in os.listdir('%s/%s'%(in_dir, data_center)):
-    with open('%s/%s/%s'%(in_dir, data_center, fn), 'r') as f:
-      for e in json.load(f):
-        method, uri, cli = e['http.request.method'], e['http.request.uri'], e['http.request.remoteaddr']
-        if method != 'GET' or len(uri.split('/')) < 2:
+def iter_records(path: str, chunk_size: int=READ_CHUNK_SIZE) -> Generator[Tuple[dict, int], None, None]:
+  # incrementally decodes a JSON array of records, yielding every record
+  # along with the length of its raw text
+  decoder = json.JSONDecoder()
+  with open(path, 'r') as f:
+    buf, pos, eof, started = '', 0, False, False
+    while True:
+      while pos < len(buf) and buf[pos] in ' \t\r\n,':
+        pos += 1
+      if pos < len(buf):
+        if not started:
+          if buf[pos] != '[':
+            raise ValueError('Expect a JSON array in %s'%path)
+          started, pos = True, pos + 1
           continue
-        event = {
-          'timestamp': datetime.datetime.fromtimestamp(parser.parse(e['timestamp']).timestamp() - e['http.request.duration']), 
-          'host': e['host'],
-          'uri': e['http.request.uri'], 
-          'status': e['http.response.status'],
-          'size': e['http.response.written'],
-        }
-        events.setdefault(cli, []).append(event)
+        if buf[pos] == ']':
+          return
+        try:
+          rec, end = decoder.raw_decode(buf, pos)
+          # the record may be truncated at the end of the buffer
+          if end < len(buf) or eof:
+            yield rec, end - pos
+            pos = end
+            continue
+        except json.JSONDecodeError:
+          if eof:
+            raise
+      elif eof:
+        if started:
+          raise ValueError('Unterminated JSON array in %s'%path)
+        return
+      chunk = f.read(chunk_size)
+      buf, pos, eof = buf[pos:] + chunk, 0, len(chunk) == 0
+
+
+@functools.lru_cache(maxsize=2 ** 16)
+def _minute_epoch(minute: str) -> int:
+  # epoch seconds of YYYY-MM-DDTHH:MM in UTC
+  dt = datetime.datetime(int(minute[:4]), int(minute[5:7]), int(minute[8:10]),
+                         int(minute[11:13]), int(minute[14:16]), tzinfo=datetime.timezone.utc)
+  return int(dt.timestamp())
+
+
+@functools.lru_cache(maxsize=256)
+def _utc_offset(tz: str) -> int:
+  if tz == 'Z':
+    return 0
+  offset = int(tz[1:3]) * 3600 + int(tz[-2:]) * 60
+  return -offset if tz[0] == '-' else offset
+
+
+def _parse_timestamp(ts: str) -> int:
+  # fallback for the timestamps not in the fixed format
+  return int(round(parser.parse(ts).timestamp() * 10 ** 6)) * 1000
+
+
+def decode_timestamps(timestamps: Iterable[str]) -> List[int]:
+  # decodes a batch of ISO-8601 timestamps into epoch nanoseconds
+  decoded = []
+  for ts in timestamps:
+    m = TIMESTAMP_RE.match(ts) if isinstance(ts, str) else None
+    if m is None or int(m.group(2)) > 59:
+      decoded += _parse_timestamp(ts),
+      continue
+    minute, sec, frac, tz = m.groups()
+    try:
+      secs = _minute_epoch(minute) + int(sec) - _utc_offset(tz)
+    except ValueError:
+      decoded += _parse_timestamp(ts),
+      continue
+    decoded += secs * NS_PER_SEC + (int(frac[:9].ljust(9, '0')) if frac else 0),
+  return decoded
+
+
+def parse_local_timestamp(ts: str) -> int:
+  # inverse of format_timestamp
+  return int(round(datetime.datetime.fromisoformat(ts).timestamp() * 10 ** 6)) * 1000
+
+
+def format_timestamp(ns: int) -> str:
+  secs, ns = divmod(ns, NS_PER_SEC)
+  return (datetime.datetime.fromtimestamp(secs) + datetime.timedelta(microseconds=round(ns/1000))).isoformat()
+
+
+def select_events(records: Iterable[Tuple[dict, int]], batch_size: int=DECODE_BATCH_SIZE) -> Generator[Tuple[str, dict, int], None, None]:
+  # yields the selected events along with their clients and raw sizes.
+  # Timestamps are decoded in batches and kept as epoch nanoseconds
+  # until the events are saved
+  batch = []
+  for e, size in records:
+    method, uri = e['http.request.method'], e['http.request.uri']
+    if method != 'GET' or len(uri.split('/')) < 2:
+      continue
+    batch += (e, size),
+    if len(batch) >= batch_size:
+      yield from _decode_events(batch)
+      batch = []
+  yield from _decode_events(batch)
+
+
+def _subtract_duration(ns: int, duration: float) -> int:
+  # subtracts the duration in floating point seconds from the timestamp 
+  # truncated to microseconds, and rounds the result half to even to 
+  # microseconds as datetime.fromtimestamp does, which keeps the output 
+  # identical to that of the datetime arithmetic
+  frac, secs = math.modf(ns // 1000 / 10 ** 6 - duration)
+  return (int(secs) * 10 ** 6 + round(frac * 10 ** 6)) * 1000
+
+
+def _decode_events(batch: List[Tuple[dict, int]]) -> Generator[Tuple[str, dict, int], None, None]:
+  timestamps = decode_timestamps([e['timestamp'] for e, _ in batch])
+  for (e, size), ts in zip(batch, timestamps):
+    yield e['http.request.remoteaddr'], {
+      'timestamp': _subtract_duration(ts, e['http.request.duration']),
+      'host': e['host'],
+      'uri': e['http.request.uri'],
+      'status': e['http.response.status'],
+      'size': e['http.response.written'],
+    }, size
+
+
+def format_events(events: Iterable[dict]) -> Generator[dict, None, None]:
+  for e in events:
+    e['timestamp'] = format_timestamp(e['timestamp'])
+    yield e
+
+
+def dump_events(events: Iterable[dict], f):
+  # equivalent to json.dump(list(events), f, indent=4) without
+  # materializing the list
+  empty = True
+  for e in events:
+    f.write('[\n    ' if empty else ',\n    ')
+    f.write(json.dumps(e, indent=4).replace('\n', '\n    '))
+    empty = False
+  f.write('[]' if empty else '\n]')
+
+
+def merge_sorted(runs: Iterable[Iterable[dict]]) -> Iterable[dict]:
+  # ties are resolved in the order of the runs, which keeps the merge stable
+  return heapq.merge(*runs, key=lambda e: e['timestamp'])
+
+
+def read_run(path: str, start: int, end: int) -> Generator[dict, None, None]:
+  with open(path, 'rb') as f:
+    f.seek(start)
+    while f.tell() < end:
+      yield json.loads(f.readline())
+
+
+def save_client(out_dir: str, cli: str, runs: Iterable[Iterable[dict]]):
+  with open('%s/%s.json'%(out_dir, cli), 'w') as f:
+    dump_events(format_events(merge_sorted(runs)), f)
+
+
+def load_client(path: str) -> Generator[dict, None, None]:
+  for e, _ in iter_records(path):
+    e['timestamp'] = parse_local_timestamp(e['timestamp'])
+    yield e
+
+
+def save_client_runs(out_dir: str, cli: str, ranges: Iterable[Tuple[str, int, int]]):
+  save_client(out_dir, cli, [read_run(*r) for r in ranges])
+
+
+def save_trace(path: str, clients: Iterable[Tuple[str, Iterable[Iterable[dict]]]]):
+  writer = columnar.TraceWriter(path)
+  for cli, runs in clients:
+    writer.add_client(cli, merge_sorted(runs))
+  print('Saving columnar trace to %s ...'%path)
+  writer.save()
+
+
+def list_inputs(in_dir: str, data_center: str) -> List[str]:
+  return ['%s/%s/%s'%(in_dir, data_center, fn) for fn in os.listdir('%s/%s'%(in_dir, data_center))]
+
+
+def stat_inputs(paths: Iterable[str]) -> Dict[str, Dict[str, float]]:
+  stats = {}
+  for p in paths:
+    st = os.stat(p)
+    stats[os.path.basename(p)] = {'size': st.st_size, 'mtime': st.st_mtime}
+  return stats
+
+
+def manifest_path(out_dir: str, data_center: str) -> str:
+  return '%s/%s.manifest.json'%(out_dir, data_center)
+
+
+def load_manifest(path: str) -> dict:
+  if not os.path.exists(path):
+    return None
+  with open(path) as f:
+    return json.load(f)
+
+
+def save_manifest(path: str, manifest: dict):
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  tmp_path = '%s.tmp'%path
+  with open(tmp_path, 'w') as f:
+    json.dump(manifest, f, indent=2)
+    f.flush()
+    os.fsync(f.fileno())
+  os.replace(tmp_path, path)
+
+
+def remove_trace(out_dir: str, data_center: str):
+  # the columnar trace takes precedence over the JSON output when the images
+  # are parsed, hence a stale one is removed whenever JSON output is written
+  path = columnar.trace_path(out_dir, data_center)
+  if os.path.exists(path):
+    shutil.rmtree(path)
+
+
+def reset_output(out_dir: str, data_center: str) -> str:
+  remove_trace(out_dir, data_center)
   out_dir = '%s/%s'%(out_dir, data_center)
   if os.path.exists(out_dir):
     shutil.rmtree(out_dir)
   os.makedirs(out_dir, exist_ok=True)
+  return out_dir
+
+
+def select_and_group(args):
+  if args.incremental:
+    return select_and_group_incremental(args)
+  man_path = manifest_path(args.output, args.data_center)
+  if os.path.exists(man_path):
+    os.remove(man_path)
+  stats = stat_inputs(list_inputs(args.input, args.data_center))
+  if args.workers > 1:
+    select_and_group_parallel(args)
+  elif args.streaming:
+    select_and_group_streaming(args)
+  else:
+    select_and_group_in_memory(args)
+  save_manifest(man_path, {'format': args.format, 'files': stats, 'pending': None})
+
+
+def select_and_group_in_memory(args):
+  in_dir, out_dir, data_center = args.input, args.output, args.data_center
+  events = {}
+  start_time = time.time()
+  for path in list_inputs(in_dir, data_center):
+    for cli, event, _ in select_events(iter_records(path)):
+      events.setdefault(cli, []).append(event)
+  if args.format == 'columnar':
+    save_trace(columnar.trace_path(out_dir, data_center), ((k, [sorted(v, key=lambda e: e['timestamp'])]) for k, v in events.items()))
+  else:
+    save_clients(out_dir, data_center, events)
+  time_elapsed = time.time() - start_time
+  print('Total clients: %d (%.3f seconds)'%(len(events), time_elapsed))
+
+
+def save_clients(out_dir: str, data_center: str, events: Dict[str, List[dict]]):
+  out_dir = reset_output(out_dir, data_center)
   for k in dict(events):
     print('Processing %s'%k)
-    print('Sorting ...')  
+    print('Sorting ...')
     events[k] = sorted(events[k], key=lambda e: e['timestamp'])
     print('Formatting timestamps ...')
-    for e in events[k]:
-      e['timestamp'] = e['timestamp'].isoformat()
+    events[k] = list(format_events(events[k]))
     print('Saving ...\n')
     with open('%s/%s.json'%(out_dir, k), 'w') as f:
-      json.dump(events[k], f, indent=4)
+      dump_events(events[k], f)
+
+
+# Buffers events by clients and spills them as sorted runs once the buffer
+# exceeds the memory budget. Each run is a JSON-lines file of the events
+# sorted by client and timestamp, indexed by the byte range of every client.
+class RunSpiller:
+
+  def __init__(self, spill_dir: str, mem_budget: int):
+    self.__spill_dir = spill_dir
+    self.__mem_budget = mem_budget
+    self.__buf, self.__buf_size = {}, 0
+    self.__runs = []
+
+  @property
+  def runs(self) -> List[Tuple[str, Dict[str, Tuple[int, int]]]]:
+    return list(self.__runs)
+
+  @property
+  def clients(self) -> List[str]:
+    clients = set(self.__buf.keys())
+    for _, index in self.__runs:
+      clients.update(index.keys())
+    return sorted(clients)
+
+  def add(self, cli: str, event: dict, size: int):
+    self.__buf.setdefault(cli, []).append(event)
+    self.__buf_size += size
+    if self.__buf_size >= self.__mem_budget:
+      self.spill()
+
+  def spill(self):
+    if not self.__buf:
+      return
+    path = '%s/run-%06d.jsonl'%(self.__spill_dir, len(self.__runs))
+    index = {}
+    with open(path, 'wb') as f:
+      for cli in sorted(self.__buf):
+        start = f.tell()
+        for e in sorted(self.__buf[cli], key=lambda e: e['timestamp']):
+          f.write(json.dumps(e).encode('utf-8'))
+          f.write(b'\n')
+        index[cli] = (start, f.tell())
+    self.__runs += (path, index),
+    self.__buf, self.__buf_size = {}, 0
+
+  def merge(self, cli: str) -> Iterable[dict]:
+    return merge_sorted([read_run(path, *index[cli])
+                         for path, index in self.__runs if cli in index])
+
+
+def select_and_group_streaming(args):
+  in_dir, out_dir, data_center = args.input, args.output, args.data_center
+  start_time = time.time()
+  spill_dir = tempfile.mkdtemp(prefix='sanitize-', dir=args.spill_dir)
+  try:
+    spiller = RunSpiller(spill_dir, args.mem_budget * 2 ** 20)
+    for path in list_inputs(in_dir, data_center):
+      print('Reading %s ...'%path)
+      for cli, event, size in select_events(iter_records(path)):
+        spiller.add(cli, event, size)
+    spiller.spill()
+    print('Spilled %d sorted runs'%len(spiller.runs))
+    clients = spiller.clients
+    if args.format == 'columnar':
+      save_trace(columnar.trace_path(out_dir, data_center), ((cli, [spiller.merge(cli)]) for cli in clients))
+    else:
+      out_dir = reset_output(out_dir, data_center)
+      for cli in clients:
+        print('Merging %s ...'%cli)
+        save_client(out_dir, cli, [spiller.merge(cli)])
+  finally:
+    shutil.rmtree(spill_dir, ignore_errors=True)
   time_elapsed = time.time() - start_time
-  print('Total clients: %d (%.3f seconds)'%(len(events), time_elapsed))
+  print('Total clients: %d (%.3f seconds)'%(len(clients), time_elapsed))
+
+
+def sort_file(path: str) -> Dict[str, List[dict]]:
+  events = {}
+  for cli, event, _ in select_events(iter_records(path)):
+    events.setdefault(cli, []).append(event)
+  for evts in events.values():
+    evts.sort(key=lambda e: e['timestamp'])
+  return events
+
+
+def spill_file(path: str, spill_dir: str, mem_budget: int) -> List[Tuple[str, Dict[str, Tuple[int, int]]]]:
+  os.makedirs(spill_dir, exist_ok=True)
+  spiller = RunSpiller(spill_dir, mem_budget)
+  for cli, event, size in select_events(iter_records(path)):
+    spiller.add(cli, event, size)
+  spiller.spill()
+  return spiller.runs
+
+
+def select_and_group_parallel(args):
+  in_dir, out_dir, data_center = args.input, args.output, args.data_center
+  start_time = time.time()
+  paths = list_inputs(in_dir, data_center)
+  print('Sorting %d files with %d workers ...'%(len(paths), args.workers))
+  with mp.Pool(args.workers) as pool:
+    if args.streaming:
+      spill_dir = tempfile.mkdtemp(prefix='sanitize-', dir=args.spill_dir)
+      try:
+        mem_budget = args.mem_budget * 2 ** 20 // args.workers
+        runs = pool.starmap(spill_file, [(p, '%s/%d'%(spill_dir, i), mem_budget)
+                                         for i, p in enumerate(paths)])
+        # runs are collected in the order of the input files for a stable merge
+        ranges = {}
+        for rs in runs:
+          for path, index in rs:
+            for cli, (start, end) in index.items():
+              ranges.setdefault(cli, []).append((path, start, end))
+        print('Merging %d clients ...'%len(ranges))
+        clients = list(ranges)
+        if args.format == 'columnar':
+          save_trace(columnar.trace_path(out_dir, data_center), ((cli, [read_run(*r) for r in rs]) for cli, rs in ranges.items()))
+        else:
+          out_dir = reset_output(out_dir, data_center)
+          pool.starmap(save_client_runs, [(out_dir, cli, rs) for cli, rs in ranges.items()], chunksize=1)
+      finally:
+        shutil.rmtree(spill_dir, ignore_errors=True)
+    else:
+      runs = pool.map(sort_file, paths, chunksize=1)
+      clients = sorted(set(cli for r in runs for cli in r))
+      print('Merging %d clients ...'%len(clients))
+      if args.format == 'columnar':
+        save_trace(columnar.trace_path(out_dir, data_center), ((cli, [r[cli] for r in runs if cli in r]) for cli in clients))
+      else:
+        out_dir = reset_output(out_dir, data_center)
+        pool.starmap(save_client, [(out_dir, cli, [r[cli] for r in runs if cli in r]) for cli in clients], chunksize=1)
+  time_elapsed = time.time() - start_time
+  print('Total clients: %d (%.3f seconds)'%(len(clients), time_elapsed))
+
+
+# Incremental runs fold the input files missing from the manifest into the
+# existing output in batches. Every batch is staged next to the output and
+# journaled in the manifest before it is moved into place, so that a crashed
+# run rolls the last batch forward and resumes from the next one.
+def select_and_group_incremental(args):
+  in_dir, out_dir, data_center = args.input, args.output, args.data_center
+  start_time = time.time()
+  man_path = manifest_path(out_dir, data_center)
+  staging_dir = '%s/%s.staging'%(out_dir, data_center)
+  manifest = load_manifest(man_path)
+  if manifest and manifest['pending']:
+    print('Resuming the interrupted batch of %d files ...'%len(manifest['pending']))
+    commit_batch(args, manifest, staging_dir)
+  elif os.path.exists(staging_dir):
+    shutil.rmtree(staging_dir)
+
+  paths = sorted(list_inputs(in_dir, data_center))
+  stats = stat_inputs(paths)
+  if manifest and (manifest['format'] != args.format
+                   or any(stats.get(fn) != st for fn, st in manifest['files'].items())):
+    print('Input files were changed or removed since the last run, rebuilding ...')
+    manifest = None
+  if manifest is None:
+    if args.format == 'columnar':
+      remove_trace(out_dir, data_center)
+    else:
+      reset_output(out_dir, data_center)
+    manifest = {'format': args.format, 'files': {}, 'pending': None}
+    save_manifest(man_path, manifest)
+
+  new_paths = [p for p in paths if os.path.basename(p) not in manifest['files']]
+  print('There are %d/%d new input files'%(len(new_paths), len(paths)))
+  pool = mp.Pool(args.workers) if args.workers > 1 else None
+  try:
+    for i in range(0, len(new_paths), args.batch_size):
+      batch = new_paths[i:i + args.batch_size]
+      print('Folding %d files ...'%len(batch))
+      runs = pool.map(sort_file, batch, chunksize=1) if pool else [sort_file(p) for p in batch]
+      os.makedirs(staging_dir, exist_ok=True)
+      stage_batch(args, runs, staging_dir)
+      manifest['pending'] = {os.path.basename(p): stats[os.path.basename(p)] for p in batch}
+      save_manifest(man_path, manifest)
+      commit_batch(args, manifest, staging_dir)
+  finally:
+    if pool:
+      pool.close()
+  time_elapsed = time.time() - start_time
+  print('Folded %d files (%.3f seconds)'%(len(new_paths), time_elapsed))
+
+
+def stage_batch(args, runs: List[Dict[str, List[dict]]], staging_dir: str):
+  out_dir, data_center = args.output, args.data_center
+  new_clients = {}
+  for r in runs:
+    for cli, evts in r.items():
+      new_clients.setdefault(cli, []).append(evts)
+  if args.format == 'columnar':
+    # only the clients with new events are merged, while the events of the
+    # others are copied from the existing trace as they are
+    path = columnar.trace_path(out_dir, data_center)
+    trace = columnar.Trace(path) if os.path.exists(path) else None
+    writer = columnar.TraceWriter('%s/trace'%staging_dir, trace)
+    n_copied = 0
+    if trace is not None:
+      for cli, events in trace.clients():
+        runs = new_clients.pop(cli, None)
+        if runs is None:
+          writer.copy_client(cli, events)
+          n_copied += 1
+        else:
+          writer.add_client(cli, merge_sorted([trace.decode(events)] + runs))
+    for cli, runs in new_clients.items():
+      writer.add_client(cli, merge_sorted(runs))
+    print('Saving columnar trace to %s, %d clients unchanged ...'%(staging_dir, n_copied))
+    writer.save()
+    return
+  for cli, evts in new_clients.items():
+    cur_path = '%s/%s/%s.json'%(out_dir, data_center, cli)
+    if os.path.exists(cur_path):
+      evts = [load_client(cur_path)] + evts
+    save_client(staging_dir, cli, evts)
+
+
+def commit_batch(args, manifest: dict, staging_dir: str):
+  out_dir, data_center = args.output, args.data_center
+  # moving the staged output is idempotent in case the commit is interrupted
+  if os.path.exists(staging_dir):
+    if manifest['format'] == 'columnar':
+      path = columnar.trace_path(out_dir, data_center)
+      staged, old = '%s/trace'%staging_dir, '%s/old'%staging_dir
+      if os.path.exists(staged):
+        if os.path.exists(path) and not os.path.exists(old):
+          os.rename(path, old)
+        os.rename(staged, path)
+    else:
+      remove_trace(out_dir, data_center)
+      for fn in os.listdir(staging_dir):
+        os.replace('%s/%s'%(staging_dir, fn), '%s/%s/%s'%(out_dir, data_center, fn))
+    shutil.rmtree(staging_dir)
+  manifest['files'].update(manifest['pending'])
+  manifest['pending'] = None
+  save_manifest(manifest_path(out_dir, data_center), manifest)
 
 
 if __name__ == '__main__':
   args = parse_args()
-  select_and_group(args)
\ No newline at end of file
+  select_and_group(args)
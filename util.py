@@ -1,6 +1,6 @@
 import os
 
-from typing import Tuple
+from typing import Iterable, List, Tuple
 from google.protobuf.timestamp_pb2 import Timestamp 
 
 
@@ -16,15 +16,56 @@ def size(nbytes: int) -> str:
   return '%.2f TB'%(nbytes/2 ** 40)
 
 
+URI_KINDS = ('manifests', 'blobs')
+
+
 def parse_uri(uri: str) -> Tuple[str, str, str]:
+  if not isinstance(uri, str):
+    return None, None, None
+  # single pass over <prefix>/<repo>/<kind>/<ref>, where no other component
+  # is a URI kind. Other URIs take the slow path
+  prefix, _, rest = uri.partition('/')
+  head, _, ref = rest.rpartition('/')
+  repo, sep, kind = head.rpartition('/')
+  if (sep and kind in URI_KINDS and prefix not in URI_KINDS and ref not in URI_KINDS
+      and 'manifests' not in repo and 'blobs' not in repo):
+    return repo, kind, ref
+  return _parse_uri(uri)
+
+
+def _parse_uri(uri: str) -> Tuple[str, str, str]:
   try:
-    assert isinstance(uri, str)
     uri = uri.split('/')
     repo_end = uri.index('manifests') if 'manifests' in uri else uri.index('blobs')
     return '/'.join(uri[1:repo_end]), uri[repo_end], uri[-1]
-  except:
+  except ValueError:
     return None, None, None
 
+
+class URIParser:
+
+  def __init__(self):
+    self.__strings = {}
+    self.__parsed = {}
+
+  def intern(self, s: str) -> str:
+    return s if s is None else self.__strings.setdefault(s, s)
+
+  def parse(self, uri: str) -> Tuple[str, str, str]:
+    # the parsed repo, kind and ref are interned, so that the images and
+    # layers parsed from the same trace share their strings
+    parsed = self.__parsed.get(uri) if isinstance(uri, str) else None
+    if parsed is None:
+      repo, kind, ref = parse_uri(uri)
+      parsed = (self.intern(repo), self.intern(kind), self.intern(ref))
+      if isinstance(uri, str):
+        self.__parsed[uri] = parsed
+    return parsed
+
+  def parse_many(self, uris: Iterable[str]) -> List[Tuple[str, str, str]]:
+    parse, parsed = self.parse, self.__parsed
+    return [(isinstance(u, str) and parsed.get(u)) or parse(u) for u in uris]
+
 def get_current_time() -> Timestamp:
   ts = Timestamp()
   ts.GetCurrentTime()